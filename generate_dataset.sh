@@ -1,7 +1,5 @@
 #!/bin/bash
-python generate_direct_answer_questions.py --template_dir Direct_Answer_templates_normal
-python generate_direct_answer_questions.py --template_dir Direct_Answer_templates_LR
-python generate_direct_answer_questions.py --template_dir Direct_Answer_templates_in_out
-python generate_direct_answer_questions.py --template_dir Direct_Answer_templates_TD
+python generate_direct_answer_questions.py --scene_cache ./cache/raven_scenes.sqlite \
+    --template_dir Direct_Answer_templates_normal Direct_Answer_templates_LR Direct_Answer_templates_in_out Direct_Answer_templates_TD
 
-python generate_logical_chain_questions.py --question_num 10
\ No newline at end of file
+python generate_logical_chain_questions.py --question_num 10
@@ -7,12 +7,12 @@
 
 from __future__ import print_function
 import argparse, json, os, random
+import itertools
 import time
 import re
-import numpy as np
 import question_engine as qeng
-import xml.etree.ElementTree as ET
-import cv2
+import raven_io
+import raven_render
 from tqdm import tqdm
 import copy
 """
@@ -49,13 +49,16 @@ parser = argparse.ArgumentParser()
 
 # Inputs
 parser.add_argument('--RAVEN_src_file', default='./RAVEN',
-                    help="RAVEN Source File")
+                    help="RAVEN Source File: the unpacked RAVEN folder or RAVEN.zip")
 parser.add_argument('--metadata_file', default='./metadata.json',
                     help="JSON file containing metadata about functions")
 parser.add_argument('--synonyms_json', default='./synonyms.json',
                     help="JSON file defining synonyms for parameter values")
-parser.add_argument('--template_dir', default='Direct_Answer_templates_normal',
-                    help="Directory containing JSON templates for questions")
+parser.add_argument('--template_dir', default=['Direct_Answer_templates_normal'], nargs='+',
+                    help="One or more directories containing JSON templates for questions. " +
+                         "Each RAVEN configuration is parsed once and routed to the template " +
+                         "family that matches it. Families are generated in the given order, each " +
+                         "from --seed, so the output matches a separate run per family.")
 # # Output
 # parser.add_argument('--output_questions_file',
 #                     default='./output/RAVEN_questions.json',
@@ -63,8 +66,12 @@ parser.add_argument('--template_dir', default='Direct_Answer_templates_normal',
 parser.add_argument('--output_dir',
                     default='./dataset/',
                     help="The output directory to write")
-parser.add_argument('--images_per_configuration', default=1000, type=int,
-                    help="The number of images per configuration")
+parser.add_argument('--scene_index', default='',
+                    help="SQLite index of the generated instances, used for sampling and lookup " +
+                         "by later stages. Defaults to scene_index.sqlite inside output_dir.")
+parser.add_argument('--images_per_configuration', default=0, type=int,
+                    help="The number of images sampled per configuration. " +
+                         "0 uses every image in the configuration.")
 # Control the number of questions per image; we will attempt to generate
 # templates_per_image * instances_per_template questions per image.
 parser.add_argument('--templates_per_image', default=100, type=int,
@@ -82,6 +89,51 @@ parser.add_argument('--verbose', action='store_true', default=False,
                     help="Print more verbose output")
 parser.add_argument('--seed', default=0, type=int,
                     help="seed")
+parser.add_argument('--num_workers', default=1, type=int,
+                    help="Number of processes used to parse the RAVEN XML files. " +
+                         "Values greater than 1 parse all configurations in parallel.")
+parser.add_argument('--render_workers', default=0, type=int,
+                    help="Number of processes that write the images while questions are being " +
+                         "generated. With 0 images are written in the main process.")
+parser.add_argument('--render_queue_size', default=64, type=int,
+                    help="Maximum number of scenes waiting to be rendered before question " +
+                         "generation pauses.")
+parser.add_argument('--render_batch_size', default=1, type=int,
+                    help="Number of instances composed together with array operations in one render " +
+                         "job. 1 renders instances one at a time.")
+parser.add_argument('--encode_threads', default=1, type=int,
+                    help="Number of threads encoding the images of a render batch")
+parser.add_argument('--image_format', default='png',
+                    help="Format of the rendered images: png (OpenCV defaults), png:N for PNG with " +
+                         "compression level N (0-9, lower is faster), webp (lossless) or npy (raw " +
+                         "arrays). Bytes and encode time per image are reported at the end of the run.")
+parser.add_argument('--output_format', default='dir', choices=['dir', 'shards', 'frames'],
+                    help="dir writes one directory per instance. shards writes size-bounded tar " +
+                         "shards in WebDataset layout into output_dir, keyed by <config>/<i>, with " +
+                         "an index of every file in shards.sqlite. frames writes question.json " +
+                         "as dir does but stores each instance's RAVEN frames once, zlib-compressed, " +
+                         "in <config>/frames.bin instead of the rendered views, which " +
+                         "raven_render.FrameStore composes on read. The render manifest is only used with dir, and " +
+                         "generate_logical_chain_questions.py needs dir output.")
+parser.add_argument('--shard_max_bytes', default=1 << 30, type=int,
+                    help="Maximum size of a tar shard in bytes")
+parser.add_argument('--lazy_render', action='store_true', default=False,
+                    help="Only render the views referenced by each instance's questions, plus " +
+                         "question and combined. generate_logical_chain_questions.py needs the " +
+                         "full set of views, so do not use this when it runs on the output.")
+parser.add_argument('--image_sizes', default=[], type=int, nargs='*',
+                    help="Also write every view resized so that its longer side is each of these " +
+                         "sizes in pixels, e.g. --image_sizes 224 448 adds panel_1_224px.png and " +
+                         "panel_1_448px.png next to panel_1.png.")
+parser.add_argument('--render_manifest', default='',
+                    help="SQLite manifest of rendered images. Instances whose images are on disk and " +
+                         "were rendered from the same NPZ with the same settings are not rendered " +
+                         "again. Defaults to render_manifest.sqlite inside output_dir.")
+parser.add_argument('--force_render', action='store_true', default=False,
+                    help="Render every instance without consulting or updating the render manifest")
+parser.add_argument('--scene_cache', default='',
+                    help="SQLite file caching parsed RAVEN scenes between runs. " +
+                         "Leave empty to disable the cache.")
 
 def precompute_filter_options(instance_struct, metadata, panel_idx, attr_keys):
     # Keys are tuples (size, color, shape, material) (where some may be None)
@@ -228,257 +280,6 @@ def other_heuristic(text, param_vals):
             text = text.replace(' another ', ' a ')
     return text
 
-def save_image(npz_file, save_dir, idx):
-    def save_image(image, filename):
-        cv2.imwrite(filename, image)
-
-    def draw_dashed_line(image, start_point, end_point, color, thickness, dash_length=3):
-        line_length = int(np.sqrt((end_point[0] - start_point[0]) ** 2 + (end_point[1] - start_point[1]) ** 2))
-        for i in range(0, line_length, 2 * dash_length):
-            start_dash = (
-                int(start_point[0] + (end_point[0] - start_point[0]) * i / line_length),
-                int(start_point[1] + (end_point[1] - start_point[1]) * i / line_length)
-            )
-            end_dash = (
-                int(start_point[0] + (end_point[0] - start_point[0]) * (i + dash_length) / line_length),
-                int(start_point[1] + (end_point[1] - start_point[1]) * (i + dash_length) / line_length)
-            )
-            cv2.line(image, start_dash, end_dash, color, thickness)
-
-    def draw_dashed_bounding_box(image, top_left, bottom_right, color, thickness=1, dash_length=3):
-        # Draw the top side
-        draw_dashed_line(image, top_left, (bottom_right[0], top_left[1]), color, thickness, dash_length)
-        # Draw the bottom side
-        draw_dashed_line(image, (top_left[0], bottom_right[1]), bottom_right, color, thickness, dash_length)
-        # Draw the left side
-        draw_dashed_line(image, top_left, (top_left[0], bottom_right[1]), color, thickness, dash_length)
-        # Draw the right side
-        draw_dashed_line(image, (bottom_right[0], top_left[1]), bottom_right, color, thickness, dash_length)
-
-    # Adjust the add_bounding_boxes function to use dashed bounding boxes
-    def add_bounding_boxes(image, img_height, img_width, rows, cols, padding=25, extra_padding=0, vertical_padding=False):
-        for col in range(cols):
-            for row in range(rows):
-                if vertical_padding and row == 1:
-                    top_left = (col * (img_width + padding) + extra_padding, row * (img_height + 2 * padding) + extra_padding)
-                    bottom_right = (top_left[0] + img_width, top_left[1] + img_height)
-                else:
-                    top_left = (col * (img_width + padding) + extra_padding, row * (img_height + padding) + extra_padding)
-                    bottom_right = (top_left[0] + img_width, top_left[1] + img_height)
-
-                draw_dashed_bounding_box(image, top_left, bottom_right, color=(0, 0, 0), thickness=1)
-
-    def add_numbers_to_panels(image, img_height, img_width, rows, cols):
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        font_scale = 0.8
-        font_thickness = 2
-        font_color = (0, 0, 0)
-
-        panel_num = 1
-        for row in range(rows):
-            for col in range(cols):
-                text = str(panel_num)
-                text_size = cv2.getTextSize(text, font, font_scale, font_thickness)[0]
-                text_x = (col * (img_width + 20) + (img_width - text_size[0]) // 2 + 40)  # Added padding
-                text_y = (row * (img_height + 40) + img_height + 65)  # Adjusted position for padding
-                cv2.putText(image, text, (int(text_x), int(text_y)), font, font_scale, font_color, font_thickness)
-                panel_num += 1
-
-    def add_vertical_text(image, text, font=cv2.FONT_HERSHEY_SIMPLEX, font_scale=0.8, font_thickness=2, padding=10, answer_set=False):
-        """
-        Adds horizontal text at the top of the image.
-        """
-        # Create a blank white image for the text
-        if answer_set:
-            text_size, _ = cv2.getTextSize(text, font, font_scale, font_thickness)
-            text_width, text_height = text_size
-            padded_height = image.shape[0] + text_height
-            padded_width = image.shape[1]
-
-            # Create the padded canvas for the image
-            padded_image = np.ones((padded_height, padded_width), dtype=np.uint8) * 255
-            padded_image[text_height:] = image
-
-            # Add horizontal text to the top of the image
-            text_x = (padded_width - text_width) // 2
-            text_y = text_height + 20  # Adjust vertical position if needed
-            cv2.putText(padded_image, text, (text_x, text_y), font, font_scale, 0, font_thickness)
-
-        else:
-            text_size, _ = cv2.getTextSize(text, font, font_scale, font_thickness)
-            text_width, text_height = text_size
-            padded_height = image.shape[0] + padding + text_height
-            padded_width = image.shape[1]
-
-            # Create the padded canvas for the image
-            padded_image = np.ones((padded_height, padded_width), dtype=np.uint8) * 255
-            padded_image[padding + text_height:] = image
-
-            # Add horizontal text to the top of the image
-            text_x = (padded_width - text_width) // 2
-            text_y = padding + text_height  # Adjust vertical position if needed
-            cv2.putText(padded_image, text, (text_x, text_y), font, font_scale, 0, font_thickness)
-
-        return padded_image
-
-    def extract_and_save_images(big_image_3x3_clean, img_height, img_width, output_dir,
-                                padding=25, extra_padding=30):
-        os.makedirs(output_dir, exist_ok=True)
-
-        # 1. Save each individual panel from the 3x3 grid (except the question mark panel)
-        panel_num = 1
-        for row in range(3):
-            for col in range(3):
-                if row == 2 and col == 2:
-                    continue  # Skip the question mark panel
-                start_y = row * (img_height + padding)
-                start_x = col * (img_width + padding)
-                panel = big_image_3x3_clean[start_y:start_y + img_height, start_x:start_x + img_width]
-                # Add extra padding around the panel
-
-                # Add extra padding around the panel
-                panel_with_padding = np.ones((img_height + 2 * extra_padding, img_width + 2 * extra_padding),
-                                             dtype=np.uint8) * 255
-                panel_with_padding[extra_padding:extra_padding + img_height,
-                extra_padding:extra_padding + img_width] = panel
-                add_bounding_boxes(panel_with_padding, img_height, img_width, 1, 1, padding, extra_padding=extra_padding)
-                save_image(panel_with_padding, os.path.join(output_dir, f'panel_{panel_num}.png'))
-                panel_num += 1
-
-        # 2. Save combinations of two panels within the same row
-        combinations = [(1, 2), (1, 3), (2, 3), (4, 5), (5, 6), (4, 6), (7, 8)]
-        for combo in combinations:
-            panel1 = combo[0] - 1
-            panel2 = combo[1] - 1
-
-            row1 = panel1 // 3
-            col1 = panel1 % 3
-            row2 = panel2 // 3
-            col2 = panel2 % 3
-
-            start_y1 = row1 * (img_height + padding)
-            start_x1 = col1 * (img_width + padding)
-            start_y2 = row2 * (img_height + padding)
-            start_x2 = col2 * (img_width + padding)
-
-            combined_image = np.ones((img_height + 2*extra_padding, 2 * img_width + padding + 2*extra_padding), dtype=np.uint8) * 255
-            combined_image[extra_padding:extra_padding+img_height, extra_padding:img_width+extra_padding] = big_image_3x3_clean[start_y1:start_y1 + img_height,
-                                            start_x1:start_x1 + img_width]
-            combined_image[extra_padding:extra_padding+img_height, img_width + padding + extra_padding:2 * img_width + padding + extra_padding] = big_image_3x3_clean[start_y2:start_y2 + img_height,
-                                                      start_x2:start_x2 + img_width]
-
-            # Draw bounding box around combined image
-            draw_dashed_bounding_box(combined_image, (extra_padding, extra_padding), (img_width+extra_padding, img_height+extra_padding), color=(0, 0, 0), thickness=1)
-            draw_dashed_bounding_box(combined_image, (img_width + padding + extra_padding, extra_padding), (2 * img_width + padding + extra_padding, img_height + extra_padding),
-                                     color=(0, 0, 0), thickness=1)
-            save_image(combined_image, os.path.join(output_dir, f'panel_combination_{combo[0]}_{combo[1]}.png'))
-
-        # 3. Save each row in the 3x3 grid with padding
-        for row in range(2):
-            row_image = big_image_3x3_clean[row * (img_height + padding):(row + 1) * (img_height + padding) - padding,
-                        :3 * img_width + 2 * padding].copy()
-            # Add extra padding to the top and bottom of the row image
-            row_image_with_padding = np.ones((row_image.shape[0] + 2 * extra_padding, row_image.shape[1] + 2 * extra_padding),
-                                             dtype=np.uint8) * 255
-            row_image_with_padding[extra_padding:extra_padding + row_image.shape[0], extra_padding:extra_padding + row_image.shape[1]] = row_image
-            add_bounding_boxes(row_image_with_padding, img_height, img_width, 1, 3, padding, extra_padding = extra_padding)
-            save_image(row_image_with_padding, os.path.join(output_dir, f'row_{row + 1}.png'))
-
-        # 4. Save the first two rows combined
-        first_two_rows_image = big_image_3x3_clean[:2 * (img_height + padding) - padding,
-                               :3 * img_width + 2 * padding].copy()
-        first_two_rows_image_with_padding = np.ones(
-            (first_two_rows_image.shape[0] + 2 * extra_padding, first_two_rows_image.shape[1] + 2 * extra_padding),
-            dtype=np.uint8) * 255
-        first_two_rows_image_with_padding[extra_padding:extra_padding + first_two_rows_image.shape[0],
-        extra_padding:extra_padding + first_two_rows_image.shape[1]] = first_two_rows_image
-        add_bounding_boxes(first_two_rows_image_with_padding, img_height, img_width, 2, 3, padding, extra_padding=extra_padding)
-        save_image(first_two_rows_image_with_padding, os.path.join(output_dir, 'first_two_rows.png'))
-
-
-    # Load images and generate the grid
-    images = npz_file['image']
-
-    # Assuming the images are all of the same size
-    img_height, img_width = images[0].shape
-
-    # Padding between the panels
-    padding = 20  # Set to the value you want
-    extra_padding = 20
-    # Create blank canvases for the 3x3 grid with padding
-    big_image_3x3_clean = np.ones((3 * img_height + 2 * padding, 3 * img_width + 2 * padding), dtype=np.uint8) * 255
-
-    # Place the first 8 images into the 3x3 grid
-    for i in range(8):
-        row = i // 3
-        col = i % 3
-        start_y = row * (img_height + padding)
-        start_x = col * (img_width + padding)
-        big_image_3x3_clean[start_y:start_y + img_height, start_x:start_x + img_width] = images[i]
-
-    # Draw a question mark in the last (9th) panel
-    question_mark_image = np.ones((img_height, img_width), dtype=np.uint8) * 255
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    font_scale = 3
-    font_thickness = 5
-    (text_width, text_height), baseline = cv2.getTextSize('?', font, font_scale, font_thickness)
-    text_x = (img_width - text_width) // 2
-    text_y = (img_height + text_height) // 2
-    cv2.putText(question_mark_image, '?', (text_x, text_y), font, font_scale, 0, font_thickness)
-    big_image_3x3_clean[2 * (img_height + padding):3 * (img_height + padding),
-    2 * (img_width + padding):3 * (img_width + padding)] = question_mark_image
-
-    # Create a copy of the clean grid with bounding boxes added
-    big_image_3x3_dashed = np.ones((3 * img_height + 2 * padding + 2 * extra_padding, 3 * img_width + 2 * padding + 2 * extra_padding), dtype=np.uint8) * 255
-
-    big_image_3x3_dashed[extra_padding:big_image_3x3_clean.shape[0]+extra_padding, extra_padding:big_image_3x3_clean.shape[1]+extra_padding] = big_image_3x3_clean.copy()
-    add_bounding_boxes(big_image_3x3_dashed, img_height, img_width, 3, 3, padding, extra_padding=extra_padding)
-
-    # Extract and save images as per the requirements
-    extract_and_save_images(big_image_3x3_clean, img_height, img_width, save_dir, padding)
-
-    cv2.imwrite(save_dir + "/question.png", big_image_3x3_dashed)
-
-    answer_extra_padding = 40
-    big_image_2x4 = np.ones((2 * img_height + 2 * padding + 2 * answer_extra_padding, 4 * img_width + 3 * padding + 2 * answer_extra_padding), dtype=np.uint8) * 255
-    for i in range(8):
-        row = i // 4
-        col = i % 4
-        start_y = row * (img_height + 2*padding) + answer_extra_padding
-        start_x = col * (img_width + padding) + answer_extra_padding
-        big_image_2x4[start_y:start_y + img_height, start_x:start_x + img_width] = images[i+8]
-
-    add_bounding_boxes(big_image_2x4, img_height, img_width, 2, 4, padding, extra_padding=answer_extra_padding, vertical_padding=True)
-    question_image = big_image_3x3_dashed
-    answer_image = big_image_2x4
-
-    add_numbers_to_panels(answer_image, img_height, img_width, 2 ,4)
-
-    question_image_with_title = add_vertical_text(question_image, "Problem Matrix", padding=20)
-    answer_image_with_title = add_vertical_text(answer_image, "Answer Set", padding=20, answer_set=True)
-
-    question_width_with_title = question_image_with_title.shape[1]
-    answer_width_with_title = answer_image_with_title.shape[1]
-
-    # Find the maximum width
-    # Find the maximum width
-    max_width = max(question_width_with_title, answer_width_with_title)
-
-    # Pad the smaller image to center it
-    if question_width_with_title < max_width:
-        total_padding = max_width - question_width_with_title
-        left_padding = total_padding // 2
-        right_padding = total_padding - left_padding
-        question_image_with_title = np.pad(question_image_with_title, ((0, 0), (left_padding, right_padding)),
-                                           mode='constant', constant_values=255)
-
-
-    # Concatenate the images vertically
-    combined_image = np.vstack((question_image_with_title, answer_image_with_title))
-
-    # Save the combined image
-    cv2.imwrite(save_dir + "/combined.png", combined_image)
-
 def instantiate_templates_dfs(instance_struct, template, metadata,
                               synonyms, config, fn, max_instances=None, verbose=False):
 
@@ -964,35 +765,36 @@ def replace_optionals(s):
     return s
 
 
-def select_filename(template_name, param_value):
+def select_filename(template_name, param_value, extension='.png'):
     filename = None
     # Determine the filename based on the template_name and param_value
     if template_name in ['basic.json', 'advanced_one_panel.json']:
         # Rule 1: Single panel
         panel_number = param_value.get('<P>') + 1
         if panel_number is not None:
-            filename = f"panel_{panel_number}.png"
+            filename = f"panel_{panel_number}{extension}"
 
     elif "advanced_two_panels" in template_name:
         # Rule 2: Two panels combination
         panel1 = param_value.get('<P>') + 1
         panel2 = param_value.get('<P2>') + 1
         if panel1 is not None and panel2 is not None and panel1 < panel2:
-            filename = f"panel_combination_{panel1}_{panel2}.png"
+            filename = f"panel_combination_{panel1}_{panel2}{extension}"
         elif panel1 is not None and panel2 is not None and panel1 > panel2:
-            filename = f"panel_combination_{panel2}_{panel1}.png"
+            filename = f"panel_combination_{panel2}_{panel1}{extension}"
     elif "reasoning_first" in template_name:
         # Rule 3: Reasoning first
-        filename = f"row_1.png"
+        filename = f"row_1{extension}"
 
     elif "reasoning_second" in template_name:
         # Rule 4: Reasoning second
-        filename = f"first_two_rows.png"
+        filename = f"first_two_rows{extension}"
 
     return filename
 
 def main(args):
     random.seed(args.seed)
+    image_encoder = raven_render.ImageEncoder(args.image_format)
 
     with open(args.metadata_file, 'r') as f:
         metadata = json.load(f)
@@ -1002,21 +804,33 @@ def main(args):
         functions_by_name[f['name']] = f
     metadata['_functions_by_name'] = functions_by_name
 
-    # Load templates from disk
+    template_matched_config = {"Direct_Answer_templates_normal": ["center_single", "distribute_four", "distribute_nine"],
+                               "Direct_Answer_templates_LR": ["left_center_single_right_center_single"],
+                               "Direct_Answer_templates_TD": ["up_center_single_down_center_single"],
+                               "Direct_Answer_templates_in_out": ["in_center_single_out_center_single", "in_distribute_four_out_center_single"]}
+
+    # Load templates from disk, one template family per directory
     # Key is (filename, file_idx)
-    num_loaded_templates = 0
-    templates = {}
-    for fn in os.listdir(args.template_dir):
-        if not fn.endswith('.json'): continue
-        with open(os.path.join(args.template_dir, fn), 'r') as f:
-            base = os.path.splitext(fn)[0]
-            for i, template in enumerate(json.load(f)):
-                num_loaded_templates += 1
-                key = (fn, i)
-                templates[key] = template
-    print('Read %d templates from disk' % num_loaded_templates)
-
-    def reset_counts():
+    templates_by_family = {}
+    config_to_family = {}
+    for template_dir in args.template_dir:
+        family = os.path.basename(os.path.normpath(template_dir))
+        assert family in template_matched_config, 'Unrecognized template directory "%s"' % template_dir
+        num_loaded_templates = 0
+        templates = {}
+        for fn in os.listdir(template_dir):
+            if not fn.endswith('.json'): continue
+            with open(os.path.join(template_dir, fn), 'r') as f:
+                for i, template in enumerate(json.load(f)):
+                    num_loaded_templates += 1
+                    key = (fn, i)
+                    templates[key] = template
+        print('Read %d templates from %s' % (num_loaded_templates, template_dir))
+        templates_by_family[family] = templates
+        for config in template_matched_config[family]:
+            config_to_family[config] = family
+
+    def reset_counts(templates):
         # Maps a template (filename, index) to the number of questions we have
         # so far using that template
         template_counts = {}
@@ -1038,7 +852,8 @@ def main(args):
                 template_answer_counts[key[:2]][a] = 0
         return template_counts, template_answer_counts
 
-    template_counts, template_answer_counts = reset_counts()
+    template_counts_by_family = {family: reset_counts(templates)[0]
+                                 for family, templates in templates_by_family.items()}
 
     # Read data file
     # all_scenes = []
@@ -1052,166 +867,57 @@ def main(args):
     #     all_scenes = all_scenes[begin:end]
     # else:
     #     all_scenes = all_scenes[begin:]
-    def get_position(bbox, config_name):
-        if config_name == "Center_Single":
-            return "center"
-        elif config_name == "Distribute_Four":
-            if bbox == '[0.25, 0.25, 0.5, 0.5]':
-                return "top-left"
-            elif bbox == '[0.25, 0.75, 0.5, 0.5]':
-                return "top-right"
-            elif bbox == '[0.75, 0.25, 0.5, 0.5]':
-                return "bottom-left"
-            elif bbox == '[0.75, 0.75, 0.5, 0.5]':
-                return "bottom-right"
-        elif config_name == "Distribute_Nine":
-            if bbox == '[0.16, 0.16, 0.33, 0.33]':
-                return "top-left"
-            elif bbox == '[0.16, 0.5, 0.33, 0.33]':
-                return "top-center"
-            elif bbox == '[0.16, 0.83, 0.33, 0.33]':
-                return "top-right"
-            elif bbox == '[0.5, 0.16, 0.33, 0.33]':
-                return "middle-left"
-            elif bbox == '[0.5, 0.5, 0.33, 0.33]':
-                return "middle-center"
-            elif bbox == '[0.5, 0.83, 0.33, 0.33]':
-                return "middle-right"
-            elif bbox == "[0.83, 0.16, 0.33, 0.33]":
-                return "bottom-left"
-            elif bbox == "[0.83, 0.5, 0.33, 0.33]":
-                return "bottom-center"
-            elif bbox == "[0.83, 0.83, 0.33, 0.33]":
-                return "bottom-right"
-        elif config_name == "Left_Center_Single":
-            return "left"
-        elif config_name == "Right_Center_Single":
-            return "right"
-        elif config_name == "Up_Center_Single":
-            return "top"
-        elif config_name == "Down_Center_Single":
-            return "bottom"
-        elif config_name == "Out_Center_Single":
-            return "outer-part"
-        elif config_name == "In_Center_Single":
-            return "inner-part"
-        elif config_name == "In_Distribute_Four":
-            if bbox == "[0.42, 0.42, 0.15, 0.15]":
-                return "top-left of the inner part"
-            elif bbox == "[0.42, 0.58, 0.15, 0.15]":
-                return "top-right of the inner part"
-            elif bbox == "[0.58, 0.42, 0.15, 0.15]":
-                return "bottom-left of the inner part"
-            elif bbox == "[0.58, 0.58, 0.15, 0.15]":
-                return "bottom-right of the inner part"
-
-    def sample_and_extract_data(root_dir, metadata, num_samples=100):
-        data = {}
-
-        # List all the configuration folders
-        config_folders = [f for f in os.listdir(root_dir) if os.path.isdir(os.path.join(root_dir, f))]
-
-        for config in config_folders:
-            config_path = os.path.join(root_dir, config)
-            all_files = [f for f in os.listdir(config_path) if f.endswith('.xml')]
-
-            # Randomly sample num_samples files from each configuration folder
-            sampled_files = all_files
-
-            data[config] = []
-
-            for file in sampled_files:
-                file_path = os.path.join(config_path, file)
-
-                # Parse the XML file
-                tree = ET.parse(file_path)
-                root = tree.getroot()
-
-                # Extract information from XML
-                example_data = {}
-                panels = []
-                for panel in root.findall('Panels/Panel'):
-                    struct = panel.find('Struct')
-                    struct_info = {
-                        'name': struct.get('name'),
-                        'components': []
-                    }
-                    entities = []
-                    for component in struct.findall('Component'):
-                        component_info = {
-                            'id': component.get('id'),
-                            'name': component.get('name'),
-                            'layout': {}
-                        }
-
-                        layout = component.find('Layout')
-                        if layout is not None:
-                            layout_info = {
-                                'name': layout.get('name'),
-                                'number': layout.get('Number'),
-                                'position': layout.get('Position'),
-                                'uniformity': layout.get('Uniformity'),
-                                'entities': []
-                            }
-
-                            for entity in layout.findall('Entity'):
-                                assert int(entity.get('Type')) >= 1
-                                entity_info = {
-                                    'position': get_position(entity.get('bbox'), layout.get('name')),
-                                    'shape': metadata['types']['Shape'][int(entity.get('Type'))-1],
-                                    'size': metadata['types']['Size'][int(entity.get('Size'))],
-                                    'color': metadata['types']['Color'][int(entity.get('Color'))]
-                                }
-                                entities.append(entity_info)
-                                # layout_info['entities'].append(entity_info)
-
-                            # component_info['layout'] = layout_info
-
-                        # struct_info['components'].append(component_info)
-
-                    panels.append(entities)
-                example_data['panels'] = panels[:8]
-                rules = []
-                for rule_group in root.findall('Rules/Rule_Group'):
-                    rule_group_info = {
-                        'id': rule_group.get('id'),
-                        'uniformity': rule_group.get('uniformity'),
-                        'rules': []
-                    }
-
-                    for rule in rule_group.findall('Rule'):
-                        rule_info = {
-                            'name': rule.get('name'),
-                            'attr': rule.get('attr'),
-                            'value': rule.get('value')
-                        }
-                        rule_group_info['rules'].append(rule_info)
-
-                    rules.append(rule_group_info)
-
-                example_data['rules'] = rules
-                example_data['filename'] = file
-                # Store the extracted data
-                data[config].append(example_data)
-
-        return data
-
-    sampled_data = sample_and_extract_data(args.RAVEN_src_file, metadata, args.images_per_configuration)
+    # Scenes are streamed from disk one at a time so memory does not grow
+    # with the number of RAVEN files being read.
+    raven_source = raven_io.open_source(args.RAVEN_src_file)
+    scene_cache = raven_io.SceneCache(args.scene_cache, metadata) if args.scene_cache else None
+    # Families are generated one after the other in --template_dir order,
+    # each from a freshly seeded random stream, so one run with several
+    # families writes the same questions as a separate run per family.
+    family_order = {os.path.basename(os.path.normpath(template_dir)): k
+                    for k, template_dir in enumerate(args.template_dir)}
+    _, scene_jobs = raven_io.list_scene_files(raven_source, args.images_per_configuration,
+                                              set(config_to_family), args.seed)
+    scene_jobs.sort(key=lambda job: family_order[config_to_family[job[0]]])
+    scene_stream = raven_io.iter_scenes(raven_source, metadata, num_workers=args.num_workers, cache=scene_cache,
+                                        jobs=scene_jobs)
 
 
     # Read synonyms file
     with open(args.synonyms_json, 'r') as f:
         synonyms = json.load(f)
 
-    template_matched_config = {"Direct_Answer_templates_normal": ["center_single", "distribute_four", "distribute_nine"],
-                               "Direct_Answer_templates_LR": ["left_center_single_right_center_single"],
-                               "Direct_Answer_templates_TD": ["up_center_single_down_center_single"],
-                               "Direct_Answer_templates_in_out": ["in_center_single_out_center_single", "in_distribute_four_out_center_single"]}
-
-    scene_count = 0
-    for config in sampled_data:
-        if config in template_matched_config[args.template_dir]:
-            for i, instance in tqdm(enumerate(sampled_data[config])):
+    scene_index = raven_io.SceneIndex(args.scene_index or os.path.join(args.output_dir, 'scene_index.sqlite'))
+    for config in config_to_family:
+        scene_index.clear_config(config)
+
+    render_manifest = None
+    shard_writer = None
+    frame_store = None
+    if args.output_format == 'shards':
+        shard_writer = raven_io.ShardWriter(args.output_dir, max_bytes=args.shard_max_bytes)
+    elif args.output_format == 'frames':
+        frame_store = raven_render.FrameStoreWriter(args.output_dir)
+    elif not args.force_render:
+        render_manifest = raven_render.RenderManifest(
+            args.render_manifest or os.path.join(args.output_dir, 'render_manifest.sqlite'))
+    # Nothing is rendered in frames mode, so no worker processes are started
+    with raven_render.RenderPool(raven_source, args.render_workers if frame_store is None else 0,
+                                 args.render_queue_size,
+                                 manifest=render_manifest, encoder=image_encoder, writer=shard_writer,
+                                 batch_size=args.render_batch_size, encode_threads=args.encode_threads,
+                                 sizes=args.image_sizes) as render_pool:
+        question_time = 0.0
+        scene_count = 0
+        family = None
+        for config, instances in itertools.groupby(scene_stream, key=lambda item: item[0]):
+            if config_to_family[config] != family:
+                family = config_to_family[config]
+                random.seed(args.seed)
+            templates = templates_by_family[config_to_family[config]]
+            template_counts = template_counts_by_family[config_to_family[config]]
+            for i, (_, instance) in tqdm(enumerate(instances)):
+                question_start = time.perf_counter()
                 questions = []
                 filename = instance['filename']
                 instance_struct = instance
@@ -1251,7 +957,7 @@ def main(args):
                             'template_filename': fn,
                             'choices': choices,
                             'config': config,
-                            'image_filename': str(i) + "/" + select_filename(fn, param_values)
+                            'image_filename': str(i) + "/" + select_filename(fn, param_values, image_encoder.extension)
                         })
 
                     if len(ts) > 0:
@@ -1264,19 +970,65 @@ def main(args):
                     if num_instantiated >= args.templates_per_image:
                         break
 
-                output_dir = args.output_dir+config
-                if not os.path.exists(output_dir + '/' + str(i)):
-                    os.makedirs(output_dir + '/' + str(i))
-                new_output_dir = output_dir + '/' + str(i)
-                with open(os.path.join(new_output_dir, "question.json"), 'w') as f:
-                    npz_file = np.load(f"{args.RAVEN_src_file}/{config}/{filename.split('.')[0]}.npz")
-                    save_image(npz_file, new_output_dir, i)
-                    json.dump({
-                        'question_num': len(questions),
-                        'rules': instance_struct['rules'],
-                        'panels': instance_struct['panels'],
-                        'questions': questions,
-                    }, f)
+                npz_name = filename.split('.')[0] + '.npz'
+                question_data = {
+                    'filename': filename,
+                    'question_num': len(questions),
+                    'rules': instance_struct['rules'],
+                    'panels': instance_struct['panels'],
+                    'questions': questions,
+                }
+                extra_files = ()
+                if shard_writer is not None:
+                    # Shard samples are keyed by the same <config>/<i> path the
+                    # image_filename values are relative to
+                    new_output_dir = config + '/' + str(i)
+                    question_path = new_output_dir + '.question.json'
+                    extra_files = [('question.json', json.dumps(question_data).encode('utf-8'))]
+                else:
+                    output_dir = args.output_dir+config
+                    if not os.path.exists(output_dir + '/' + str(i)):
+                        os.makedirs(output_dir + '/' + str(i))
+                    new_output_dir = output_dir + '/' + str(i)
+                    question_path = os.path.abspath(os.path.join(new_output_dir, "question.json"))
+                    with open(question_path, 'w') as f:
+                        json.dump(question_data, f)
+                scene_index.add_scene(config, i, instance, question_path, len(questions),
+                                      raven_source.location(config, filename),
+                                      raven_source.location(config, npz_name))
+                question_time += time.perf_counter() - question_start
+                views = None
+                if args.lazy_render:
+                    # Only the views the questions point at, plus the full problem
+                    views = {'question', 'combined'}
+                    views.update(os.path.splitext(os.path.basename(q['image_filename']))[0] for q in questions)
+                if frame_store is not None:
+                    with raven_source.open_npz(config, npz_name) as npz_file:
+                        frame_store.append(config, i, npz_file['image'])
+                    continue
+                render_pool.submit(config, npz_name, new_output_dir, i, views, extra_files)
+            scene_index.commit()
+            render_pool.commit()
+            if frame_store is not None:
+                frame_store.commit()
+
+    print('questions: %d scenes in %.1fs (%.1f scenes/s)' % (scene_count, question_time,
+                                                             scene_count / max(question_time, 1e-9)))
+    if frame_store is None:
+        print(render_pool.report())
+    if render_manifest is not None:
+        render_manifest.close()
+    if frame_store is not None:
+        print('frames: %.1f MB written to %s (%.1f MB uncompressed)'
+              % (frame_store.num_bytes / 1e6, args.output_dir, frame_store.raw_bytes / 1e6))
+        frame_store.close()
+    if shard_writer is not None:
+        print('shards: %d written to %s' % (shard_writer.num_shards, args.output_dir))
+        shard_writer.close()
+    scene_index.close()
+    raven_source.close()
+    if scene_cache is not None:
+        scene_cache.close()
 
 
 if __name__ == '__main__':
@@ -6,6 +6,7 @@ from collections import defaultdict
 import numpy as np
 from pathlib import Path
 import argparse
+import raven_io
 
 root_path = './dataset'
 output_dir = 'logical_chain_questions.json'
@@ -15,24 +16,35 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--question_num', default=10, type=int,
                     help="The number of different templates that should be instantiated " +
                          "on each image")
+parser.add_argument('--image_extension', default='.png',
+                    help="Extension of the images written by generate_direct_answer_questions.py " +
+                         "(e.g. .webp when it was run with --image_format webp)")
 args = parser.parse_args()
 
 def sample_dataset():
     dataset_path = Path("dataset")
     samples_per_config = args.question_num
     total_data_points = count_subfolders_os("./dataset/center_single")
+
+    # Use the scene index written by generate_direct_answer_questions.py when
+    # available instead of probing question.json paths one by one
+    index_path = dataset_path / "scene_index.sqlite"
+    scene_index = raven_io.SceneIndex(str(index_path)) if index_path.exists() else None
     
     # Get all configuration directories
     configurations = [d for d in dataset_path.iterdir() if d.is_dir()]
     sampled_paths = []
     
     for config in configurations:
-        # Generate list of available data numbers (assuming 0-999 or 1-1000)
-        available_data_nums = []
-        for i in range(total_data_points):  # Check both 0-based and 1-based numbering
-            question_path = config / str(i) / "question.json"
-            if question_path.exists():
-                available_data_nums.append(i)
+        if scene_index is not None:
+            available_data_nums = scene_index.instances(config.name)
+        else:
+            # Generate list of available data numbers (assuming 0-999 or 1-1000)
+            available_data_nums = []
+            for i in range(total_data_points):  # Check both 0-based and 1-based numbering
+                question_path = config / str(i) / "question.json"
+                if question_path.exists():
+                    available_data_nums.append(i)
         
         sample_size = samples_per_config
         
@@ -338,7 +350,7 @@ def generate_question_answer(data, panel_index, stage, attribute):
             config = data["questions"][0]["config"]
             image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
             directory = os.path.dirname(image_path)
-            new_filename = f"panel_{panel_index+1}.png"
+            new_filename = f"panel_{panel_index+1}{args.image_extension}"
             new_path = os.path.join(directory, new_filename)
             # Return the question and the list of answer choices
         elif stage == "two_panels":
@@ -360,7 +372,7 @@ def generate_question_answer(data, panel_index, stage, attribute):
             config = data["questions"][0]["config"]
             image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
             directory = os.path.dirname(image_path)
-            new_filename = f"panel_combination_{panel_index+1}_{panel_index+2}.png"
+            new_filename = f"panel_combination_{panel_index+1}_{panel_index+2}{args.image_extension}"
             new_path = os.path.join(directory, new_filename)
         elif stage == "one_row":
             for question in data["questions"]:
@@ -392,7 +404,7 @@ def generate_question_answer(data, panel_index, stage, attribute):
             config = data["questions"][0]["config"]
             image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
             directory = os.path.dirname(image_path)
-            new_filename = f"panel_{panel_index+1}.png"
+            new_filename = f"panel_{panel_index+1}{args.image_extension}"
             new_path = os.path.join(directory, new_filename)
             # Return the question and the list of answer choices
         elif stage == "two_panels":
@@ -417,7 +429,7 @@ def generate_question_answer(data, panel_index, stage, attribute):
             config = data["questions"][0]["config"]
             image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
             directory = os.path.dirname(image_path)
-            new_filename = f"panel_combination_{panel_index+1}_{panel_index+2}.png"
+            new_filename = f"panel_combination_{panel_index+1}_{panel_index+2}{args.image_extension}"
             new_path = os.path.join(directory, new_filename)
         elif stage == "one_row":
             for question in data["questions"]:
@@ -449,7 +461,7 @@ def generate_question_answer(data, panel_index, stage, attribute):
             config = data["questions"][0]["config"]
             image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
             directory = os.path.dirname(image_path)
-            new_filename = f"panel_{panel_index+1}.png"
+            new_filename = f"panel_{panel_index+1}{args.image_extension}"
             new_path = os.path.join(directory, new_filename)
             # Return the question and the list of answer choices
         elif stage == "two_panels":
@@ -492,7 +504,7 @@ def generate_question_answer(data, panel_index, stage, attribute):
             config = data["questions"][0]["config"]
             image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
             directory = os.path.dirname(image_path)
-            new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+            new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
             new_path = os.path.join(directory, new_filename)
         elif stage == "one_row":
             for question in data["questions"]:
@@ -524,7 +536,7 @@ def generate_question_answer(data, panel_index, stage, attribute):
             config = data["questions"][0]["config"]
             image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
             directory = os.path.dirname(image_path)
-            new_filename = f"panel_{panel_index+1}.png"
+            new_filename = f"panel_{panel_index+1}{args.image_extension}"
             new_path = os.path.join(directory, new_filename)
             # Return the question and the list of answer choices
         elif stage == "two_panels":
@@ -565,7 +577,7 @@ def generate_question_answer(data, panel_index, stage, attribute):
             config = data["questions"][0]["config"]
             image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
             directory = os.path.dirname(image_path)
-            new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+            new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
             new_path = os.path.join(directory, new_filename)
         elif stage == "one_row":
             for question in data["questions"]:
@@ -597,7 +609,7 @@ def generate_question_answer(data, panel_index, stage, attribute):
             config = data["questions"][0]["config"]
             image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
             directory = os.path.dirname(image_path)
-            new_filename = f"panel_{panel_index+1}.png"
+            new_filename = f"panel_{panel_index+1}{args.image_extension}"
             new_path = os.path.join(directory, new_filename)
             # Return the question and the list of answer choices
         elif stage == "two_panels":
@@ -638,7 +650,7 @@ def generate_question_answer(data, panel_index, stage, attribute):
             config = data["questions"][0]["config"]
             image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
             directory = os.path.dirname(image_path)
-            new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+            new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
             new_path = os.path.join(directory, new_filename)
         elif stage == "one_row":
             for question in data["questions"]:
@@ -680,7 +692,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index+1}.png"
+                new_filename = f"panel_{panel_index+1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif "two_panels" in stage:
@@ -697,7 +709,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index+1}_{panel_index+2}.png"
+                new_filename = f"panel_combination_{panel_index+1}_{panel_index+2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif "one_row" in stage:
                 for question in data["questions"]:
@@ -733,7 +745,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index+1}.png"
+                new_filename = f"panel_{panel_index+1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif "two_panels" in stage:
@@ -751,7 +763,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index+1}_{panel_index+2}.png"
+                new_filename = f"panel_combination_{panel_index+1}_{panel_index+2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif "one_row" in stage:
                 for question in data["questions"]:
@@ -785,7 +797,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index+1}.png"
+                new_filename = f"panel_{panel_index+1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif "two_panels" in stage:
@@ -822,7 +834,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif "one_row" in stage:
                 for question in data["questions"]:
@@ -847,7 +859,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index+1}.png"
+                new_filename = f"panel_{panel_index+1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif "two_panels" in stage:
@@ -884,7 +896,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif "one_row" in stage:
                 for question in data["questions"]:
@@ -909,7 +921,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index+1}.png"
+                new_filename = f"panel_{panel_index+1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif "two_panels" in stage:
@@ -945,7 +957,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif "one_row" in stage:
                 for question in data["questions"]:
@@ -981,7 +993,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -998,7 +1010,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1036,7 +1048,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1054,7 +1066,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1090,7 +1102,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1128,7 +1140,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1156,7 +1168,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1193,7 +1205,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1220,7 +1232,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1256,7 +1268,7 @@ def generate_question_answer_LR(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1300,7 +1312,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1317,7 +1329,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1355,7 +1367,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1373,7 +1385,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1409,7 +1421,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1447,7 +1459,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1475,7 +1487,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1512,7 +1524,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1539,7 +1551,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1575,7 +1587,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1613,7 +1625,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1630,7 +1642,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1668,7 +1680,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1686,7 +1698,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1722,7 +1734,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1760,7 +1772,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1788,7 +1800,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1825,7 +1837,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1852,7 +1864,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1888,7 +1900,7 @@ def generate_question_answer_TD(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1932,7 +1944,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -1949,7 +1961,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -1987,7 +1999,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -2005,7 +2017,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -2041,7 +2053,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -2079,7 +2091,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -2107,7 +2119,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -2144,7 +2156,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -2171,7 +2183,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -2207,7 +2219,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -2248,7 +2260,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -2278,7 +2290,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -2318,7 +2330,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -2345,7 +2357,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -2383,7 +2395,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -2428,7 +2440,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -2462,7 +2474,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -2505,7 +2517,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -2538,7 +2550,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_{panel_index + 1}.png"
+                new_filename = f"panel_{panel_index + 1}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
                 # Return the question and the list of answer choices
             elif stage == "two_panels":
@@ -2580,7 +2592,7 @@ def generate_question_answer_in_out(data, panel_index, stage, attribute):
                 config = data["questions"][0]["config"]
                 image_path = os.path.join(root_path, config, data["questions"][0]["image_filename"])
                 directory = os.path.dirname(image_path)
-                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}.png"
+                new_filename = f"panel_combination_{panel_index + 1}_{panel_index + 2}{args.image_extension}"
                 new_path = os.path.join(directory, new_filename)
             elif stage == "one_row":
                 for question in data["questions"]:
@@ -2637,14 +2649,15 @@ logical_chain_questions = load_questions_from_json(sampled_files)
 # with open("logical_chain_questions.json", "r") as json_file:
 #     data = json.load(json_file)
 data = logical_chain_questions
-root_dir = "./RAVEN"
+root_dir = "./RAVEN" if os.path.isdir("./RAVEN") else "./RAVEN.zip"
+raven_source = raven_io.open_source(root_dir)
 for instance in data:
     npz_file_name = instance["original_filename"].split(".")[0] + ".npz"
     config = instance["questions"][0]["config"]
-    npz_file_path = os.path.join(root_dir, config, npz_file_name)
-        
-    npz_file = np.load(npz_file_path)
-    answer = npz_file['target']
+
+    # Only the target is needed here, so avoid decompressing the image stack
+    with raven_source.open_npz(config, npz_file_name) as npz_file:
+        answer = npz_file.read('target')
     prompt = "You are presented with a 3x3 grid of panels, called the 'Problem Matrix.' The last panel is missing and marked with a '?' symbol. "
     
     if config == "in_center_single_out_center_single" or config == "in_distribute_four_out_center_single":
@@ -2658,7 +2671,7 @@ for instance in data:
     final_question = {"question": prompt,
                     "correct_answer": int(answer),
                     "config": config,
-                    "image_path": os.path.join(os.path.dirname(instance["questions"][0]["image_path"]), "combined.png"),
+                    "image_path": os.path.join(os.path.dirname(instance["questions"][0]["image_path"]), "combined" + args.image_extension),
                     "stage": "final"}
     instance["questions"].append(final_question)
     
@@ -486,6 +486,53 @@ def two_panel_position_equal_comparison(scene_struct, inputs, side_inputs):
   else:
     return "No"
 
+# Rules are stored per rule group, with the group's uniformity as a string
+# such as "{'Left': True}". Single-component configurations use one group
+# keyed by 'Grid' (queried as side 'Normal'); the two-component ones keep the
+# Left/Up/Out component in the first group and Right/Down/In in the second.
+RULE_SIDES = ['Normal', 'Left', 'Right', 'Up', 'Down', 'In', 'Out']
+RULE_ATTRIBUTES = ['Number', 'Position', 'Type', 'Size', 'Color']
+
+
+def index_rules(rules):
+  """
+  Normalise the raw rule groups of a scene into a dict mapping each side
+  present in the scene to its parsed uniformity, its rules and, for every
+  rule attribute, the first rule that covers it.
+  """
+  parsed_uniformity = [ast.literal_eval(group['uniformity']) if group['uniformity'] is not None else {}
+                       for group in rules]
+  index = {}
+  for side in RULE_SIDES:
+    if side == "Normal":
+      group_idx, key = 0, 'Grid'
+    elif side == "Left" or side == "Up" or side == "Out":
+      group_idx, key = 0, side
+    else:
+      group_idx, key = 1, side
+    if group_idx >= len(rules) or key not in parsed_uniformity[group_idx]:
+      continue
+    by_attr = {}
+    for rule in rules[group_idx]['rules']:
+      for attr in RULE_ATTRIBUTES:
+        if attr in rule['attr'] and attr not in by_attr:
+          by_attr[attr] = rule
+    index[side] = {
+      'uniformity': parsed_uniformity[group_idx][key],
+      'rules': rules[group_idx]['rules'],
+      'by_attr': by_attr,
+    }
+  return index
+
+
+def get_rule_group(scene_struct, side):
+  # Scenes read through raven_io are indexed at ingest time; index any other
+  # scene on first use.
+  if '_rule_index' not in scene_struct:
+    scene_struct['_rule_index'] = index_rules(scene_struct['rules'])
+  return scene_struct['_rule_index'][side]
+
+
 def query_number_rule_handler(scene_struct, inputs, side_inputs):
   assert len(side_inputs) == 1
 
@@ -494,115 +541,44 @@ def query_number_rule_handler(scene_struct, inputs, side_inputs):
   # Check if all other panels have the same number of objects
   for panel in scene_struct['panels']:
     if len(panel) != num_objects_in_first_panel:
-      if side_inputs[0] == "Normal":
-        rules = scene_struct['rules'][0]
-        uniformity = ast.literal_eval(rules['uniformity'])['Grid']
-
-      elif side_inputs[0] == "Left" or side_inputs[0] == "Up" or side_inputs[0] == "Out":
-        rules = scene_struct['rules'][0]
-        uniformity = ast.literal_eval(rules['uniformity'])[side_inputs[0]]
-
-      else:
-        rules = scene_struct['rules'][1]
-        uniformity = ast.literal_eval(rules['uniformity'])[side_inputs[0]]
-
-      for rule in rules['rules']:
-        if 'Number' in rule['attr']:
-          return describe_rule(rule['name'], rule['value'], 'Number')
+      rule = get_rule_group(scene_struct, side_inputs[0])['by_attr'].get('Number')
+      if rule is not None:
+        return describe_rule(rule['name'], rule['value'], 'Number')
 
       return "No clear rule is present."
 
   return "The number of objects remains constant."
+
 def query_position_rule_handler(scene_struct, inputs, side_inputs):
   assert len(side_inputs) == 1
-  if side_inputs[0] == "Normal":
-    rules = scene_struct['rules'][0]
-    uniformity = ast.literal_eval(rules['uniformity'])['Grid']
-
-  elif side_inputs[0] == "Left" or side_inputs[0] == "Up" or side_inputs[0] == "Out":
-    rules = scene_struct['rules'][0]
-    uniformity = ast.literal_eval(rules['uniformity'])[side_inputs[0]]
-
-  else:
-    rules = scene_struct['rules'][1]
-    uniformity = ast.literal_eval(rules['uniformity'])[side_inputs[0]]
-
-  for rule in rules['rules']:
-    if 'Position' in rule['attr']:
-      return describe_rule(rule['name'], rule['value'], 'Position')
+  rule = get_rule_group(scene_struct, side_inputs[0])['by_attr'].get('Position')
+  if rule is not None:
+    return describe_rule(rule['name'], rule['value'], 'Position')
   return "No clear rule is present."
 
+def describe_attribute_rule(scene_struct, side, attr):
+  rule_group = get_rule_group(scene_struct, side)
+  rule = rule_group['by_attr'].get(attr)
+  if rule is None:
+    return "No clear rule is present."
+  first_rule_name = rule_group['rules'][0]['name']
+  first_rule_type = rule_group['rules'][0]['attr']
+  if rule_group['uniformity'] == False and rule['name'] == 'Constant':
+    if (first_rule_type == 'Position' and first_rule_name == 'Arithmetic') or (first_rule_type == 'Number'):
+      return "No clear rule is present."
+  return describe_rule(rule['name'], rule['value'], attr)
+
 def query_shape_rule_handler(scene_struct, inputs, side_inputs):
   assert len(side_inputs) == 1
-  if side_inputs[0] == "Normal":
-    rules = scene_struct['rules'][0]
-    uniformity = ast.literal_eval(rules['uniformity'])['Grid']
-
-  elif side_inputs[0] == "Left" or side_inputs[0] == "Up" or side_inputs[0] == "Out":
-    rules = scene_struct['rules'][0]
-    uniformity = ast.literal_eval(rules['uniformity'])[side_inputs[0]]
-
-  else:
-    rules = scene_struct['rules'][1]
-    uniformity = ast.literal_eval(rules['uniformity'])[side_inputs[0]]
-
-  for rule in rules['rules']:
-    if 'Type' in rule['attr']:
-      first_rule_name = rules['rules'][0]['name']
-      first_rule_type = rules['rules'][0]['attr']
-      if uniformity == False and rule['name'] == 'Constant':
-        if (first_rule_type == 'Position' and first_rule_name == 'Arithmetic') or (first_rule_type == 'Number'):
-          return "No clear rule is present."
-      return describe_rule(rule['name'], rule['value'], 'Type')
-  return "No clear rule is present."
+  return describe_attribute_rule(scene_struct, side_inputs[0], 'Type')
 
 def query_size_rule_handler(scene_struct, inputs, side_inputs):
   assert len(side_inputs) == 1
-  if side_inputs[0] == "Normal":
-    rules = scene_struct['rules'][0]
-    uniformity = ast.literal_eval(rules['uniformity'])['Grid']
-
-  elif side_inputs[0] == "Left" or side_inputs[0] == "Up" or side_inputs[0] == "Out":
-    rules = scene_struct['rules'][0]
-    uniformity = ast.literal_eval(rules['uniformity'])[side_inputs[0]]
-
-  else:
-    rules = scene_struct['rules'][1]
-    uniformity = ast.literal_eval(rules['uniformity'])[side_inputs[0]]
-
-  for rule in rules['rules']:
-    if 'Size' in rule['attr']:
-      first_rule_name = rules['rules'][0]['name']
-      first_rule_type = rules['rules'][0]['attr']
-      if uniformity == False and rule['name'] == 'Constant':
-        if (first_rule_type == 'Position' and first_rule_name == 'Arithmetic') or (first_rule_type == 'Number'):
-          return "No clear rule is present."
-      return describe_rule(rule['name'], rule['value'], 'Size')
-  return "No clear rule is present."
+  return describe_attribute_rule(scene_struct, side_inputs[0], 'Size')
 
 def query_color_rule_handler(scene_struct, inputs, side_inputs):
   assert len(side_inputs) == 1
-  if side_inputs[0] == "Normal":
-    rules = scene_struct['rules'][0]
-    uniformity = ast.literal_eval(rules['uniformity'])['Grid']
-
-  elif side_inputs[0] == "Left" or side_inputs[0] == "Up" or side_inputs[0] == "Out":
-    rules = scene_struct['rules'][0]
-    uniformity = ast.literal_eval(rules['uniformity'])[side_inputs[0]]
-
-  else:
-    rules = scene_struct['rules'][1]
-    uniformity = ast.literal_eval(rules['uniformity'])[side_inputs[0]]
-
-  for rule in rules['rules']:
-    if 'Color' in rule['attr']:
-      first_rule_name = rules['rules'][0]['name']
-      first_rule_type = rules['rules'][0]['attr']
-      if uniformity == False and rule['name'] == 'Constant':
-        if (first_rule_type == 'Position' and first_rule_name == 'Arithmetic') or (first_rule_type == 'Number'):
-          return "No clear rule is present."
-      return describe_rule(rule['name'], rule['value'], 'Color')
-  return "No clear rule is present."
+  return describe_attribute_rule(scene_struct, side_inputs[0], 'Color')
 
 def describe_rule(name, value, type):
   if type == "Number":
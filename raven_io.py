@@ -0,0 +1,824 @@
+"""
+Utilities for reading RAVEN scenes from disk.
+
+Each RAVEN instance is stored as an XML annotation file plus an NPZ archive
+holding the rendered frames. This module turns the XML annotations into the
+`{'panels': ..., 'rules': ..., 'filename': ...}` records consumed by the
+question engine. RAVEN can be read either from the unpacked folder tree or
+directly from RAVEN.zip; see open_source.
+"""
+
+import io
+import os
+import json
+import time
+import zlib
+import glob
+import struct
+import zipfile
+import collections
+import random
+import hashlib
+import pickle
+import sqlite3
+import tarfile
+import threading
+import multiprocessing
+import multiprocessing.pool
+import xml.etree.ElementTree as ET
+import numpy as np
+import question_engine as qeng
+
+# Bump whenever the structure returned by extract_example_data changes so that
+# stale scene caches are discarded.
+SCENE_CACHE_VERSION = 2
+
+
+# Layouts whose entities always occupy the same slot.
+FIXED_LAYOUT_POSITIONS = {
+    "Center_Single": "center",
+    "Left_Center_Single": "left",
+    "Right_Center_Single": "right",
+    "Up_Center_Single": "top",
+    "Down_Center_Single": "bottom",
+    "Out_Center_Single": "outer-part",
+    "In_Center_Single": "inner-part",
+}
+
+# Slots of the grid layouts, keyed by the parsed bbox attribute
+# (row, column, height, width) of RAVEN entities.
+GRID_LAYOUT_POSITIONS = {
+    "Distribute_Four": {
+        (0.25, 0.25, 0.5, 0.5): "top-left",
+        (0.25, 0.75, 0.5, 0.5): "top-right",
+        (0.75, 0.25, 0.5, 0.5): "bottom-left",
+        (0.75, 0.75, 0.5, 0.5): "bottom-right",
+    },
+    "Distribute_Nine": {
+        (0.16, 0.16, 0.33, 0.33): "top-left",
+        (0.16, 0.5, 0.33, 0.33): "top-center",
+        (0.16, 0.83, 0.33, 0.33): "top-right",
+        (0.5, 0.16, 0.33, 0.33): "middle-left",
+        (0.5, 0.5, 0.33, 0.33): "middle-center",
+        (0.5, 0.83, 0.33, 0.33): "middle-right",
+        (0.83, 0.16, 0.33, 0.33): "bottom-left",
+        (0.83, 0.5, 0.33, 0.33): "bottom-center",
+        (0.83, 0.83, 0.33, 0.33): "bottom-right",
+    },
+    "In_Distribute_Four": {
+        (0.42, 0.42, 0.15, 0.15): "top-left of the inner part",
+        (0.42, 0.58, 0.15, 0.15): "top-right of the inner part",
+        (0.58, 0.42, 0.15, 0.15): "bottom-left of the inner part",
+        (0.58, 0.58, 0.15, 0.15): "bottom-right of the inner part",
+    },
+}
+
+
+def _parse_bbox(bbox):
+    try:
+        if isinstance(bbox, str):
+            bbox = bbox.strip('[] ').split(',')
+        return tuple(float(value) for value in bbox)
+    except (TypeError, ValueError):
+        return None
+
+
+def decode_positions(layout_name, bboxes):
+    """
+    Decode the positions of all entities of one layout in a single call.
+    bboxes is a sequence of bbox attribute strings (or of numeric
+    [row, col, height, width] sequences). Unknown layouts, unparsable bboxes
+    and bboxes that are not exactly one of the layout's slots decode to None.
+    """
+    if layout_name in FIXED_LAYOUT_POSITIONS:
+        return [FIXED_LAYOUT_POSITIONS[layout_name]] * len(bboxes)
+    slots = GRID_LAYOUT_POSITIONS.get(layout_name)
+    if slots is None:
+        return [None] * len(bboxes)
+    return [slots.get(_parse_bbox(bbox)) for bbox in bboxes]
+
+
+def get_position(bbox, config_name):
+    return decode_positions(config_name, [bbox])[0]
+
+
+# NumPy parses .npy headers with ast.literal_eval, which some CPython 3.11
+# releases cannot run from several threads at once.
+_npy_header_lock = threading.Lock()
+
+
+def _read_npy_header(fp):
+    version = np.lib.format.read_magic(fp)
+    with _npy_header_lock:
+        if version == (1, 0):
+            return np.lib.format.read_array_header_1_0(fp)
+        return np.lib.format.read_array_header_2_0(fp)
+
+
+def _member_data_offset(fp, info):
+    # The offset stored in the central directory points at the member's local
+    # header, whose variable-length name and extra fields precede the data.
+    fp.seek(info.header_offset)
+    local_header = fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+    return info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+
+class NpzArchive(object):
+    """
+    Member-selective reader for .npz archives. Unlike np.load, which hands out
+    whole members, it can read just a leading slice of frames of one member
+    and memory-maps uncompressed members instead of copying them.
+
+    Supports the subset of the np.load interface used here: `archive[name]`,
+    `archive.files` and use as a context manager.
+    """
+
+    def __init__(self, file, mmap=True):
+        self.file = file
+        self.mmap = mmap and isinstance(file, str)
+        self.zip = zipfile.ZipFile(file)
+        self.files = [name[:-len('.npy')] if name.endswith('.npy') else name for name in self.zip.namelist()]
+
+    def __getitem__(self, name):
+        return self.read(name)
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+
+    def read(self, name, frames=None):
+        """
+        Read member `name`. If frames is given, only the first `frames`
+        entries along the first axis are read.
+        """
+        info = self.zip.getinfo(name if name.endswith('.npy') else name + '.npy')
+        with self.zip.open(info) as fp:
+            shape, fortran_order, dtype = _read_npy_header(fp)
+            header_length = fp.tell()
+            if frames is not None and len(shape) > 0 and not fortran_order:
+                shape = (min(frames, shape[0]),) + tuple(shape[1:])
+
+            if (self.mmap and info.compress_type == zipfile.ZIP_STORED and not dtype.hasobject
+                    and int(np.prod(shape)) > 0):
+                with open(self.file, 'rb') as raw:
+                    offset = _member_data_offset(raw, info) + header_length
+                array = np.memmap(self.file, dtype=dtype, mode='r', offset=offset, shape=shape,
+                                  order='F' if fortran_order else 'C')
+            elif dtype.hasobject:
+                fp.seek(0)
+                array = np.lib.format.read_array(fp, allow_pickle=False)
+            else:
+                count = int(np.prod(shape))
+                array = np.frombuffer(fp.read(count * dtype.itemsize), dtype=dtype, count=count)
+                array = array.reshape(shape, order='F' if fortran_order else 'C')
+        if frames is not None and fortran_order:
+            array = array[:frames]
+        return array
+
+
+def read_npz_member(file, name, frames=None):
+    """
+    Read a single member of an .npz archive; see NpzArchive.read.
+    """
+    with NpzArchive(file) as archive:
+        return archive.read(name, frames)
+
+
+def file_cache_key(path):
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+
+def file_location(path):
+    return path, 0, os.path.getsize(path)
+
+
+class DirectorySource(object):
+    """
+    RAVEN unpacked into one folder per configuration.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def list_configs(self):
+        return [f for f in os.listdir(self.root_dir) if os.path.isdir(os.path.join(self.root_dir, f))]
+
+    def list_files(self, config, suffix):
+        return [f for f in os.listdir(os.path.join(self.root_dir, config)) if f.endswith(suffix)]
+
+    def path(self, config, name):
+        return os.path.join(self.root_dir, config, name)
+
+    def read(self, config, name):
+        with self.open(config, name) as f:
+            return f.read()
+
+    def open(self, config, name):
+        return open(self.path(config, name), 'rb')
+
+    def open_npz(self, config, name):
+        return NpzArchive(self.path(config, name))
+
+    def cache_key(self, config, name):
+        return file_cache_key(self.path(config, name))
+
+    def location(self, config, name):
+        return file_location(self.path(config, name))
+
+    def clone(self):
+        return self
+
+    def close(self):
+        pass
+
+
+class ZipSource(object):
+    """
+    RAVEN read directly from RAVEN.zip, without unpacking it.
+
+    The central directory is read once into a {config: {filename: ZipInfo}}
+    index. Members are then read by seeking to their recorded offsets in a
+    single open handle, so there are no per-file open or stat calls. The
+    index travels with the object when it is pickled, so worker processes
+    share it instead of re-reading the archive directory.
+    """
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.members = collections.OrderedDict()
+        with zipfile.ZipFile(zip_path) as zf:
+            for info in zf.infolist():
+                parts = info.filename.split('/')
+                if info.is_dir() or len(parts) < 2 or parts[0] == '__MACOSX':
+                    continue
+                self.members.setdefault(parts[-2], collections.OrderedDict())[parts[-1]] = info
+        self._fp = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fp'] = None
+        return state
+
+    def _file(self):
+        if self._fp is None:
+            self._fp = open(self.zip_path, 'rb')
+        return self._fp
+
+    def clone(self):
+        """
+        Return a ZipSource that shares this one's member index but reads
+        through its own file handle, e.g. for use from another thread.
+        """
+        clone = ZipSource.__new__(ZipSource)
+        clone.__dict__.update(self.__getstate__())
+        return clone
+
+    def list_configs(self):
+        return list(self.members)
+
+    def list_files(self, config, suffix):
+        return [name for name in self.members[config] if name.endswith(suffix)]
+
+    def read(self, config, name):
+        info = self.members[config][name]
+        fp = self._file()
+        fp.seek(_member_data_offset(fp, info))
+        data = fp.read(info.compress_size)
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        elif info.compress_type != zipfile.ZIP_STORED:
+            with zipfile.ZipFile(self.zip_path) as zf:
+                return zf.read(info)
+        if zlib.crc32(data) != info.CRC:
+            raise zipfile.BadZipFile('Bad CRC-32 for %s in %s' % (info.filename, self.zip_path))
+        return data
+
+    def open(self, config, name):
+        return io.BytesIO(self.read(config, name))
+
+    def open_npz(self, config, name):
+        return NpzArchive(self.open(config, name))
+
+    def cache_key(self, config, name):
+        info = self.members[config][name]
+        mtime = time.mktime(info.date_time + (0, 0, -1))
+        return '%s!%s' % (os.path.abspath(self.zip_path), info.filename), int(mtime * 1e9), info.file_size
+
+    def location(self, config, name):
+        info = self.members[config][name]
+        return self.zip_path, _member_data_offset(self._file(), info), info.compress_size
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+def open_source(path):
+    """
+    Return a RAVEN source for path: a ZipSource if it is a zip archive
+    (e.g. RAVEN.zip), otherwise a DirectorySource. Sources are returned as is.
+    """
+    if isinstance(path, (DirectorySource, ZipSource)):
+        return path
+    if os.path.isfile(path) and zipfile.is_zipfile(path):
+        return ZipSource(path)
+    return DirectorySource(path)
+
+
+def _extract_panel(panel, metadata):
+    struct = panel.find('Struct')
+    entities = []
+    for component in struct.findall('Component'):
+        layout = component.find('Layout')
+        if layout is not None:
+            layout_entities = layout.findall('Entity')
+            positions = decode_positions(layout.get('name'), [entity.get('bbox') for entity in layout_entities])
+            for entity, position in zip(layout_entities, positions):
+                assert int(entity.get('Type')) >= 1
+                entity_info = {
+                    'position': position,
+                    'shape': metadata['types']['Shape'][int(entity.get('Type'))-1],
+                    'size': metadata['types']['Size'][int(entity.get('Size'))],
+                    'color': metadata['types']['Color'][int(entity.get('Color'))]
+                }
+                entities.append(entity_info)
+    return entities
+
+
+def _extract_rule_group(rule_group):
+    rule_group_info = {
+        'id': rule_group.get('id'),
+        'uniformity': rule_group.get('uniformity'),
+        'rules': []
+    }
+
+    for rule in rule_group.findall('Rule'):
+        rule_info = {
+            'name': rule.get('name'),
+            'attr': rule.get('attr'),
+            'value': rule.get('value')
+        }
+        rule_group_info['rules'].append(rule_info)
+    return rule_group_info
+
+
+def extract_example_data(file_path, metadata, filename=None):
+    """
+    Parse a single RAVEN XML file (a path or a binary file object) into the
+    example structure used by the question generator.
+
+    The file is read incrementally; each panel and rule group is converted
+    as soon as its closing tag is seen and its subtree is then discarded.
+    """
+    example_data = {}
+    panels = []
+    rules = []
+    path = []
+    for event, elem in ET.iterparse(file_path, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            continue
+        path.pop()
+        if elem.tag == 'Panel' and path[1:] == ['Panels']:
+            panels.append(_extract_panel(elem, metadata))
+            elem.clear()
+        elif elem.tag == 'Rule_Group' and path[1:] == ['Rules']:
+            rules.append(_extract_rule_group(elem))
+            elem.clear()
+
+    example_data['panels'] = panels[:8]
+    example_data['rules'] = rules
+    example_data['filename'] = filename if filename is not None else os.path.basename(file_path)
+    # Parsed uniformity and per-side rule lookups used by the rule handlers
+    example_data['_rule_index'] = qeng.index_rules(rules)
+    return example_data
+
+
+class SceneCache(object):
+    """
+    SQLite-backed cache of parsed scenes. Entries are keyed by the XML file's
+    absolute path (or archive!member name) and are only reused while its
+    mtime and size are unchanged; see the sources' cache_key methods.
+    The whole cache is dropped if the metadata used to decode attribute values
+    differs from the one it was built with.
+    """
+
+    def __init__(self, path, metadata):
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS scenes '
+                          '(path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, data BLOB)')
+        types = json.dumps(metadata['types'], sort_keys=True).encode('utf-8')
+        fingerprint = '%d:%s' % (SCENE_CACHE_VERSION, hashlib.sha1(types).hexdigest())
+        row = self.conn.execute("SELECT value FROM info WHERE key = 'fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            self.conn.execute('DELETE FROM scenes')
+            self.conn.execute("INSERT OR REPLACE INTO info VALUES ('fingerprint', ?)", (fingerprint,))
+            self.conn.commit()
+
+    def get(self, key):
+        path, mtime_ns, size = key
+        row = self.conn.execute('SELECT mtime_ns, size, data FROM scenes WHERE path = ?', (path,)).fetchone()
+        if row is None or row[0] != mtime_ns or row[1] != size:
+            return None
+        return pickle.loads(row[2])
+
+    def put(self, key, example_data):
+        path, mtime_ns, size = key
+        data = pickle.dumps(example_data, protocol=pickle.HIGHEST_PROTOCOL)
+        self.conn.execute('INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?)',
+                          (path, mtime_ns, size, sqlite3.Binary(data)))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class SceneIndex(object):
+    """
+    SQLite index over a generated dataset. Each row maps a configuration and
+    instance index to the RAVEN filename it was generated from, a summary of
+    its rules, the object count of every panel and the location of its
+    source files, so scenes can be sampled, stratified by rule or looked up
+    by filename without walking the dataset directories.
+    """
+
+    def __init__(self, path, check_same_thread=True):
+        index_dir = os.path.dirname(path)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=check_same_thread)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('CREATE TABLE IF NOT EXISTS scenes ('
+                          'config TEXT, idx INTEGER, filename TEXT, question_path TEXT, num_questions INTEGER, '
+                          'object_counts TEXT, rules TEXT, xml_path TEXT, xml_offset INTEGER, xml_size INTEGER, '
+                          'npz_path TEXT, npz_offset INTEGER, npz_size INTEGER, PRIMARY KEY (config, idx))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS scenes_filename ON scenes (filename)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS rules ('
+                          'config TEXT, idx INTEGER, component INTEGER, attr TEXT, name TEXT, value TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS rules_attr_name ON rules (attr, name)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS rules_scene ON rules (config, idx)')
+
+    def clear_config(self, config):
+        self.conn.execute('DELETE FROM scenes WHERE config = ?', (config,))
+        self.conn.execute('DELETE FROM rules WHERE config = ?', (config,))
+
+    def add_scene(self, config, idx, example_data, question_path, num_questions,
+                  xml_location=(None, None, None), npz_location=(None, None, None)):
+        """
+        Add or replace the row of one instance. The locations are
+        (path, offset, size) triples of the instance's XML and NPZ data.
+        Their paths are stored absolute, so the index can be used from any
+        working directory.
+        """
+        xml_location, npz_location = [(os.path.abspath(path) if path is not None else None, offset, size)
+                                      for path, offset, size in (xml_location, npz_location)]
+        object_counts = [len(panel) for panel in example_data['panels']]
+        rules = [[[rule['attr'], rule['name'], rule['value']] for rule in group['rules']]
+                 for group in example_data['rules']]
+        self.conn.execute('DELETE FROM rules WHERE config = ? AND idx = ?', (config, idx))
+        self.conn.execute('INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          (config, idx, example_data['filename'], question_path, num_questions,
+                           json.dumps(object_counts), json.dumps(rules)) + tuple(xml_location) + tuple(npz_location))
+        self.conn.executemany('INSERT INTO rules VALUES (?, ?, ?, ?, ?, ?)',
+                              [(config, idx, component, attr, name, value)
+                               for component, group in enumerate(rules) for attr, name, value in group])
+
+    def instances(self, config):
+        rows = self.conn.execute('SELECT idx FROM scenes WHERE config = ? ORDER BY idx', (config,))
+        return [row['idx'] for row in rows]
+
+    def sample(self, config, num_samples, rng=random):
+        return rng.sample(self.instances(config), num_samples)
+
+    def get(self, config, idx):
+        return self.conn.execute('SELECT * FROM scenes WHERE config = ? AND idx = ?', (config, idx)).fetchone()
+
+    def lookup(self, filename, config=None):
+        if config is None:
+            return self.conn.execute('SELECT * FROM scenes WHERE filename = ?', (filename,)).fetchall()
+        return self.conn.execute('SELECT * FROM scenes WHERE filename = ? AND config = ?',
+                                 (filename, config)).fetchall()
+
+    def by_rule(self, attr, name, config=None):
+        """
+        Return the scenes having a rule named `name` on an attribute
+        containing `attr` (e.g. 'Number' matches 'Number/Position').
+        """
+        query = ('SELECT DISTINCT scenes.* FROM scenes JOIN rules ON scenes.config = rules.config '
+                 'AND scenes.idx = rules.idx WHERE rules.attr LIKE ? AND rules.name = ?')
+        params = ['%' + attr + '%', name]
+        if config is not None:
+            query += ' AND scenes.config = ?'
+            params.append(config)
+        return self.conn.execute(query + ' ORDER BY scenes.config, scenes.idx', params).fetchall()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class ShardIndex(object):
+    """
+    SQLite index of the files stored in a set of tar shards: for every
+    (key, name) the shard it is in and the offset and size of its data, so a
+    single file can be read with one seek.
+    """
+
+    def __init__(self, path):
+        index_dir = os.path.dirname(path)
+        self.shard_dir = index_dir
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files (key TEXT, name TEXT, shard TEXT, '
+                          'offset INTEGER, size INTEGER, PRIMARY KEY (key, name))')
+
+    def clear(self):
+        self.conn.execute('DELETE FROM files')
+
+    def add(self, key, name, shard, offset, size):
+        self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', (key, name, shard, offset, size))
+
+    def names(self, key):
+        return [row[0] for row in self.conn.execute('SELECT name FROM files WHERE key = ? ORDER BY rowid', (key,))]
+
+    def read(self, key, name):
+        row = self.conn.execute('SELECT shard, offset, size FROM files WHERE key = ? AND name = ?',
+                                (key, name)).fetchone()
+        if row is None:
+            raise KeyError('%s.%s' % (key, name))
+        with open(os.path.join(self.shard_dir, row[0]), 'rb') as f:
+            f.seek(row[1])
+            return f.read(row[2])
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def _padded(size, unit):
+    return -(-size // unit) * unit
+
+
+class ShardWriter(object):
+    """
+    Writes samples into size-bounded tar shards in WebDataset layout. The
+    files of a sample are stored next to each other as <key>.<name>, e.g.
+    center_single/12.question.json and center_single/12.panel_1.png, and a
+    new shard is started before one would grow past max_bytes. Every file is
+    recorded in a ShardIndex stored next to the shards. Shards with the same
+    prefix left in output_dir by an earlier run are deleted.
+    """
+
+    def __init__(self, output_dir, prefix='shard', max_bytes=1 << 30, index_name='shards.sqlite'):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.index = ShardIndex(os.path.join(output_dir, index_name))
+        self.index.clear()
+        for path in glob.glob(os.path.join(glob.escape(output_dir), glob.escape(prefix) + '-' + '[0-9]' * 6 + '.tar')):
+            os.remove(path)
+        self.num_shards = 0
+        self.tar = None
+        self.shard = None
+
+    def _next_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+        self.shard = '%s-%06d.tar' % (self.prefix, self.num_shards)
+        self.tar = tarfile.open(os.path.join(self.output_dir, self.shard), 'w', format=tarfile.USTAR_FORMAT)
+        self.num_shards += 1
+
+    def write(self, key, files):
+        """
+        Add one sample given as a list of (name, bytes) pairs.
+        """
+        # Each file takes a header block plus its data padded to whole blocks.
+        # Closing a shard adds two zero blocks and pads it to whole records.
+        size = sum(tarfile.BLOCKSIZE + _padded(len(data), tarfile.BLOCKSIZE) for _, data in files)
+        if self.tar is None or (self.tar.offset > 0 and
+                                _padded(self.tar.offset + size + 2 * tarfile.BLOCKSIZE, tarfile.RECORDSIZE) >
+                                self.max_bytes):
+            self._next_shard()
+        mtime = int(time.time())
+        for name, data in files:
+            info = tarfile.TarInfo('%s.%s' % (key, name))
+            info.size = len(data)
+            info.mtime = mtime
+            self.tar.addfile(info, io.BytesIO(data))
+            # The data ends at the current offset, padded to whole blocks
+            self.index.add(key, name, self.shard, self.tar.offset - _padded(len(data), tarfile.BLOCKSIZE), len(data))
+
+    def commit(self):
+        self.index.commit()
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+        self.index.close()
+
+
+def build_scene_index(dataset_dir, raven_dir, index_path):
+    """
+    Index a dataset produced by generate_direct_answer_questions.py from its
+    question.json files.
+    """
+    source = open_source(raven_dir)
+    index = SceneIndex(index_path)
+    for config in sorted(os.listdir(dataset_dir)):
+        config_dir = os.path.join(dataset_dir, config)
+        if not os.path.isdir(config_dir):
+            continue
+        index.clear_config(config)
+        for instance in os.listdir(config_dir):
+            question_path = os.path.abspath(os.path.join(config_dir, instance, 'question.json'))
+            if not instance.isdigit() or not os.path.exists(question_path):
+                continue
+            with open(question_path, 'r') as f:
+                data = json.load(f)
+            # Datasets written before question.json recorded the scene's
+            # filename only have it on each question
+            filename = data.get('filename')
+            if filename is None:
+                if not data['questions']:
+                    continue
+                filename = data['questions'][0]['filename']
+            example_data = {'panels': data['panels'], 'rules': data['rules'], 'filename': filename}
+            index.add_scene(config, int(instance), example_data, question_path, data['question_num'],
+                            source.location(config, filename),
+                            source.location(config, os.path.splitext(filename)[0] + '.npz'))
+    index.close()
+    source.close()
+
+
+# Worker processes receive the metadata and the RAVEN source once through the
+# pool initializer instead of having them pickled alongside every file.
+_worker_metadata = None
+_worker_source = None
+
+
+def _init_worker(metadata, source):
+    global _worker_metadata, _worker_source
+    _worker_metadata = metadata
+    _worker_source = source
+
+
+def _parse_scene(source, config, name, metadata):
+    with source.open(config, name) as f:
+        return extract_example_data(f, metadata, filename=name)
+
+
+def _extract_worker(job):
+    config, name = job
+    return _parse_scene(_worker_source, config, name, _worker_metadata)
+
+
+def list_scene_files(source, num_samples=0, configs=None, seed=0):
+    """
+    Return the configuration folders of a RAVEN source and the list of
+    (config, xml_filename) pairs to read from them.
+
+    If num_samples is positive and smaller than a configuration's file count,
+    a random subset of that size is drawn from the listing. The subset
+    depends only on seed and the configuration name, so it does not consume
+    the caller's random state. Files keep their listing order, which for
+    RAVEN.zip is the order they are stored in. If configs is given, only
+    those configuration folders are listed.
+    """
+    # List all the configuration folders
+    config_folders = source.list_configs()
+    if configs is not None:
+        config_folders = [f for f in config_folders if f in configs]
+
+    jobs = []
+    for config in config_folders:
+        all_files = source.list_files(config, '.xml')
+
+        # Randomly sample num_samples files from each configuration folder
+        if 0 < num_samples < len(all_files):
+            rng = random.Random('%s:%s' % (seed, config))
+            sampled = set(rng.sample(sorted(all_files), num_samples))
+            sampled_files = [f for f in all_files if f in sampled]
+        else:
+            sampled_files = all_files
+
+        for file in sampled_files:
+            jobs.append((config, file))
+
+    return config_folders, jobs
+
+
+def _load_scene(source, config, name, metadata, cache):
+    key = source.cache_key(config, name) if cache is not None else None
+    example_data = cache.get(key) if cache is not None else None
+    if example_data is None:
+        example_data = _parse_scene(source, config, name, metadata)
+        if cache is not None:
+            cache.put(key, example_data)
+    return example_data
+
+
+def iter_scenes(root_dir, metadata, num_samples=0, num_workers=1, cache=None, configs=None, seed=0,
+                prefetch=64, jobs=None):
+    """
+    Yield (config, example_data) pairs one scene at a time, in listing order.
+    root_dir is a RAVEN folder, RAVEN.zip or a source from open_source.
+
+    With num_workers > 1 files are parsed by a pool of processes, keeping at
+    most prefetch files in flight so memory stays bounded however many files
+    are read. If a SceneCache is given, files it already holds are not parsed
+    again and newly parsed files are added to it. If jobs is given, as
+    returned by list_scene_files, those files are read instead of listing the
+    source again.
+    """
+    source = open_source(root_dir)
+    if jobs is None:
+        _, jobs = list_scene_files(source, num_samples, configs, seed)
+
+    try:
+        if num_workers <= 1:
+            for config, name in jobs:
+                yield config, _load_scene(source, config, name, metadata, cache)
+            return
+
+        with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(metadata, source)) as pool:
+            pending = collections.deque()
+            jobs = iter(jobs)
+            while True:
+                while len(pending) < prefetch:
+                    job = next(jobs, None)
+                    if job is None:
+                        break
+                    key = source.cache_key(*job) if cache is not None else None
+                    example_data = cache.get(key) if cache is not None else None
+                    if example_data is None:
+                        example_data = pool.apply_async(_extract_worker, (job,))
+                    pending.append((job[0], key, example_data))
+                if not pending:
+                    break
+                config, key, example_data = pending.popleft()
+                if isinstance(example_data, multiprocessing.pool.AsyncResult):
+                    example_data = example_data.get()
+                    if cache is not None:
+                        cache.put(key, example_data)
+                yield config, example_data
+    finally:
+        if cache is not None:
+            cache.commit()
+
+
+def sample_and_extract_data(root_dir, metadata, num_samples=0, num_workers=1, cache=None, configs=None,
+                            seed=0):
+    """
+    Parse the RAVEN XML files below root_dir into a dict mapping each
+    configuration folder to its list of scenes. See iter_scenes for the
+    meaning of the arguments; prefer iter_scenes when the scenes do not all
+    need to be held in memory at once.
+    """
+    source = open_source(root_dir)
+    config_folders, jobs = list_scene_files(source, num_samples, configs, seed)
+    data = {config: [] for config in config_folders}
+    for config, example_data in iter_scenes(source, metadata, num_workers=num_workers, cache=cache, jobs=jobs):
+        data[config].append(example_data)
+
+    return data
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Build the scene index of an already generated dataset")
+    parser.add_argument('--dataset_dir', default='./dataset/',
+                        help="Directory written by generate_direct_answer_questions.py")
+    parser.add_argument('--RAVEN_src_file', default='./RAVEN',
+                        help="RAVEN Source File: the unpacked RAVEN folder or RAVEN.zip")
+    parser.add_argument('--scene_index', default='',
+                        help="Index file to write. Defaults to scene_index.sqlite inside dataset_dir.")
+    args = parser.parse_args()
+    build_scene_index(args.dataset_dir, args.RAVEN_src_file,
+                      args.scene_index or os.path.join(args.dataset_dir, 'scene_index.sqlite'))
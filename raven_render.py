@@ -0,0 +1,1049 @@
+"""
+Rendering of the per-instance images (panels, rows, question and combined
+views) from a RAVEN NPZ archive.
+
+RenderPool runs save_image in a pool of worker processes behind a bounded
+queue, so question generation in the main process does not wait for image
+encoding. With a RenderManifest, scenes whose images are already on disk and
+were rendered from the same NPZ with the same settings are skipped.
+"""
+
+import io
+import os
+import json
+import time
+import zlib
+import hashlib
+import sqlite3
+import collections
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import cv2
+import raven_io
+
+# Bump whenever the rendered images change for the same input so that
+# render manifests no longer treat existing outputs as current.
+RENDER_VERSION = 1
+
+
+def draw_dashed_line(image, start_point, end_point, color, thickness, dash_length=3):
+    line_length = int(np.sqrt((end_point[0] - start_point[0]) ** 2 + (end_point[1] - start_point[1]) ** 2))
+    for i in range(0, line_length, 2 * dash_length):
+        start_dash = (
+            int(start_point[0] + (end_point[0] - start_point[0]) * i / line_length),
+            int(start_point[1] + (end_point[1] - start_point[1]) * i / line_length)
+        )
+        end_dash = (
+            int(start_point[0] + (end_point[0] - start_point[0]) * (i + dash_length) / line_length),
+            int(start_point[1] + (end_point[1] - start_point[1]) * (i + dash_length) / line_length)
+        )
+        cv2.line(image, start_dash, end_dash, color, thickness)
+
+
+def draw_dashed_bounding_box(image, top_left, bottom_right, color, thickness=1, dash_length=3):
+    # Draw the top side
+    draw_dashed_line(image, top_left, (bottom_right[0], top_left[1]), color, thickness, dash_length)
+    # Draw the bottom side
+    draw_dashed_line(image, (top_left[0], bottom_right[1]), bottom_right, color, thickness, dash_length)
+    # Draw the left side
+    draw_dashed_line(image, top_left, (top_left[0], bottom_right[1]), color, thickness, dash_length)
+    # Draw the right side
+    draw_dashed_line(image, (bottom_right[0], top_left[1]), bottom_right, color, thickness, dash_length)
+
+
+def grid_boxes(img_height, img_width, rows, cols, padding=25, extra_padding=0, vertical_padding=False):
+    """
+    Return the (top_left, bottom_right) corners of the panel boxes in a
+    rows x cols grid, in the order they are drawn.
+    """
+    boxes = []
+    for col in range(cols):
+        for row in range(rows):
+            if vertical_padding and row == 1:
+                top_left = (col * (img_width + padding) + extra_padding, row * (img_height + 2 * padding) + extra_padding)
+            else:
+                top_left = (col * (img_width + padding) + extra_padding, row * (img_height + padding) + extra_padding)
+            boxes.append((top_left, (top_left[0] + img_width, top_left[1] + img_height)))
+    return tuple(boxes)
+
+
+# Dashed-box overlays depend only on the image shape and box corners, so each
+# one is drawn once with draw_dashed_bounding_box and kept as a boolean mask.
+_dashed_box_masks = {}
+
+
+def dashed_box_mask(shape, boxes):
+    """
+    Return a boolean mask of the pixels covered by black dashed boxes drawn
+    around boxes on an image of the given shape. Setting image[mask] = 0
+    gives the same pixels as drawing the boxes with draw_dashed_bounding_box.
+    """
+    key = (tuple(shape), boxes)
+    mask = _dashed_box_masks.get(key)
+    if mask is None:
+        canvas = np.full(shape, 255, dtype=np.uint8)
+        for top_left, bottom_right in boxes:
+            draw_dashed_bounding_box(canvas, top_left, bottom_right, color=(0, 0, 0), thickness=1)
+        mask = canvas != 255
+        _dashed_box_masks[key] = mask
+    return mask
+
+
+def add_bounding_boxes(image, img_height, img_width, rows, cols, padding=25, extra_padding=0, vertical_padding=False):
+    boxes = grid_boxes(img_height, img_width, rows, cols, padding, extra_padding, vertical_padding)
+    image[dashed_box_mask(image.shape, boxes)] = 0
+
+
+def add_numbers_to_panels(image, img_height, img_width, rows, cols):
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = 0.8
+    font_thickness = 2
+    font_color = (0, 0, 0)
+
+    panel_num = 1
+    for row in range(rows):
+        for col in range(cols):
+            text = str(panel_num)
+            text_size = cv2.getTextSize(text, font, font_scale, font_thickness)[0]
+            text_x = (col * (img_width + 20) + (img_width - text_size[0]) // 2 + 40)  # Added padding
+            text_y = (row * (img_height + 40) + img_height + 65)  # Adjusted position for padding
+            cv2.putText(image, text, (int(text_x), int(text_y)), font, font_scale, font_color, font_thickness)
+            panel_num += 1
+
+
+def add_vertical_text(image, text, font=cv2.FONT_HERSHEY_SIMPLEX, font_scale=0.8, font_thickness=2, padding=10, answer_set=False):
+    """
+    Adds horizontal text at the top of the image.
+    """
+    # Create a blank white image for the text
+    if answer_set:
+        text_size, _ = cv2.getTextSize(text, font, font_scale, font_thickness)
+        text_width, text_height = text_size
+        padded_height = image.shape[0] + text_height
+        padded_width = image.shape[1]
+
+        # Create the padded canvas for the image
+        padded_image = np.ones((padded_height, padded_width), dtype=np.uint8) * 255
+        padded_image[text_height:] = image
+
+        # Add horizontal text to the top of the image
+        text_x = (padded_width - text_width) // 2
+        text_y = text_height + 20  # Adjust vertical position if needed
+        cv2.putText(padded_image, text, (text_x, text_y), font, font_scale, 0, font_thickness)
+
+    else:
+        text_size, _ = cv2.getTextSize(text, font, font_scale, font_thickness)
+        text_width, text_height = text_size
+        padded_height = image.shape[0] + padding + text_height
+        padded_width = image.shape[1]
+
+        # Create the padded canvas for the image
+        padded_image = np.ones((padded_height, padded_width), dtype=np.uint8) * 255
+        padded_image[padding + text_height:] = image
+
+        # Add horizontal text to the top of the image
+        text_x = (padded_width - text_width) // 2
+        text_y = padding + text_height  # Adjust vertical position if needed
+        cv2.putText(padded_image, text, (text_x, text_y), font, font_scale, 0, font_thickness)
+
+    return padded_image
+
+
+def question_mark_tile(img_height, img_width):
+    question_mark_image = np.ones((img_height, img_width), dtype=np.uint8) * 255
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = 3
+    font_thickness = 5
+    (text_width, text_height), baseline = cv2.getTextSize('?', font, font_scale, font_thickness)
+    text_x = (img_width - text_width) // 2
+    text_y = (img_height + text_height) // 2
+    cv2.putText(question_mark_image, '?', (text_x, text_y), font, font_scale, 0, font_thickness)
+    return question_mark_image
+
+
+def blank_canvas(height, width):
+    return np.full((height, width), 255, dtype=np.uint8)
+
+
+class CanvasTemplate(object):
+    """
+    One output view with everything that does not depend on the instance
+    already drawn: padding, dashed boxes, titles, answer numbers and the
+    question mark tile. placements lists the (frame, y, x) slots that the
+    RAVEN frames are copied into.
+
+    The background is drawn with white frames, so its black pixels inside
+    the frame slots are overlay strokes (e.g. the top and left edges of the
+    dashed boxes) that are drawn over the frames and must be put back after
+    the frames are copied in.
+
+    The output buffer starts as a copy of the background, and rendering only
+    writes the frame slots and the overlay pixels inside them, so everything
+    outside the slots stays valid between calls. Templates with the same
+    background and slot positions (e.g. the eight single panels) can share
+    one buffer; see share_buffers.
+    """
+
+    def __init__(self, background, placements, img_height, img_width):
+        self.background = background
+        self.placements = placements
+        self.img_height = img_height
+        self.img_width = img_width
+        self.slots = tuple(sorted((y, x) for _, y, x in placements))
+        slots = np.zeros(background.shape, dtype=bool)
+        for y, x in self.slots:
+            slots[y:y + img_height, x:x + img_width] = True
+        self.overlay = np.flatnonzero(slots & (background == 0))
+        self.buffer = background.copy()
+        self.batch_owner = self
+        self.batch_buffer = None
+
+    def same_layout(self, other):
+        return (self.slots == other.slots and self.img_height == other.img_height and
+                self.img_width == other.img_width and np.array_equal(self.background, other.background))
+
+    def render(self, images):
+        """
+        Return the view for the given frame stack. The returned array is
+        overwritten by the next call on this template or any template sharing
+        its buffer, and must not be modified.
+        """
+        out = self.buffer
+        for frame, y, x in self.placements:
+            out[y:y + self.img_height, x:x + self.img_width] = images[frame]
+        out.reshape(-1)[self.overlay] = 0
+        return out
+
+    def render_batch(self, stack):
+        """
+        Batched render: return the views of an (N, 16, H, W) stack of frame
+        stacks as an (N, height, width) array, with one array operation per
+        frame slot for the whole batch. Like render, the result is
+        overwritten by the next call and must not be modified.
+        """
+        owner = self.batch_owner
+        if owner.batch_buffer is None or len(owner.batch_buffer) < len(stack):
+            owner.batch_buffer = np.repeat(self.background[np.newaxis], len(stack), axis=0)
+        out = owner.batch_buffer[:len(stack)]
+        for frame, y, x in self.placements:
+            out[:, y:y + self.img_height, x:x + self.img_width] = stack[:, frame]
+        out.reshape(len(stack), -1)[:, self.overlay] = 0
+        return out
+
+
+def share_buffers(templates):
+    """
+    Let templates with the same layout render into one buffer, so an
+    instance needs one buffer per distinct layout rather than per view.
+    """
+    owners = []
+    for template in templates:
+        for owner in owners:
+            if owner.same_layout(template):
+                template.buffer = owner.buffer
+                template.batch_owner = owner
+                break
+        else:
+            owners.append(template)
+    return len(owners)
+
+
+PANEL_COMBINATIONS = [(1, 2), (1, 3), (2, 3), (4, 5), (5, 6), (4, 6), (7, 8)]
+
+# Every view written by save_image, in the order they are written.
+VIEW_NAMES = (['panel_%d' % (i + 1) for i in range(8)] +
+              ['panel_combination_%d_%d' % combo for combo in PANEL_COMBINATIONS] +
+              ['row_1', 'row_2', 'first_two_rows', 'question', 'combined'])
+
+
+def build_canvas_templates(img_height, img_width, padding=20, extra_padding=20, panel_padding=30,
+                           answer_padding=40):
+    """
+    Build the templates of every view written by save_image, keyed by file
+    name in the order they are written.
+    """
+    h, w = img_height, img_width
+    templates = collections.OrderedDict()
+
+    def add(name, canvas, placements):
+        templates[name] = CanvasTemplate(canvas, placements, h, w)
+
+    # 1. Each individual panel from the 3x3 grid (except the question mark panel)
+    for i in range(8):
+        canvas = blank_canvas(h + 2 * panel_padding, w + 2 * panel_padding)
+        add_bounding_boxes(canvas, h, w, 1, 1, padding, extra_padding=panel_padding)
+        add('panel_%d' % (i + 1), canvas, [(i, panel_padding, panel_padding)])
+
+    # 2. Combinations of two panels within the same row
+    for first, second in PANEL_COMBINATIONS:
+        canvas = blank_canvas(h + 2 * panel_padding, 2 * w + padding + 2 * panel_padding)
+        boxes = (((panel_padding, panel_padding), (w + panel_padding, h + panel_padding)),
+                 ((w + padding + panel_padding, panel_padding),
+                  (2 * w + padding + panel_padding, h + panel_padding)))
+        canvas[dashed_box_mask(canvas.shape, boxes)] = 0
+        add('panel_combination_%d_%d' % (first, second), canvas,
+            [(first - 1, panel_padding, panel_padding), (second - 1, panel_padding, w + padding + panel_padding)])
+
+    # 3. Each of the first two rows of the 3x3 grid
+    for row in range(2):
+        canvas = blank_canvas(h + 2 * panel_padding, 3 * w + 2 * padding + 2 * panel_padding)
+        add_bounding_boxes(canvas, h, w, 1, 3, padding, extra_padding=panel_padding)
+        add('row_%d' % (row + 1), canvas,
+            [(3 * row + col, panel_padding, panel_padding + col * (w + padding)) for col in range(3)])
+
+    # 4. The first two rows combined
+    canvas = blank_canvas(2 * h + padding + 2 * panel_padding, 3 * w + 2 * padding + 2 * panel_padding)
+    add_bounding_boxes(canvas, h, w, 2, 3, padding, extra_padding=panel_padding)
+    add('first_two_rows', canvas,
+        [(i, panel_padding + i // 3 * (h + padding), panel_padding + i % 3 * (w + padding)) for i in range(6)])
+
+    # 5. The problem matrix with the question mark in the last (9th) panel
+    question_image = blank_canvas(3 * h + 2 * padding + 2 * extra_padding, 3 * w + 2 * padding + 2 * extra_padding)
+    question_y = extra_padding + 2 * (h + padding)
+    question_x = extra_padding + 2 * (w + padding)
+    question_image[question_y:question_y + h, question_x:question_x + w] = question_mark_tile(h, w)
+    add_bounding_boxes(question_image, h, w, 3, 3, padding, extra_padding=extra_padding)
+    question_placements = [(i, extra_padding + i // 3 * (h + padding), extra_padding + i % 3 * (w + padding))
+                           for i in range(8)]
+    add('question', question_image, question_placements)
+
+    # 6. The problem matrix above the answer set, both titled
+    answer_image = blank_canvas(2 * h + 2 * padding + 2 * answer_padding, 4 * w + 3 * padding + 2 * answer_padding)
+    answer_placements = [(i + 8, i // 4 * (h + 2 * padding) + answer_padding, i % 4 * (w + padding) + answer_padding)
+                         for i in range(8)]
+    add_bounding_boxes(answer_image, h, w, 2, 4, padding, extra_padding=answer_padding, vertical_padding=True)
+    add_numbers_to_panels(answer_image, h, w, 2, 4)
+
+    question_image_with_title = add_vertical_text(question_image, "Problem Matrix", padding=20)
+    answer_image_with_title = add_vertical_text(answer_image, "Answer Set", padding=20, answer_set=True)
+    question_top = question_image_with_title.shape[0] - question_image.shape[0]
+    answer_top = question_image_with_title.shape[0] + answer_image_with_title.shape[0] - answer_image.shape[0]
+
+    # Pad the smaller image to center it
+    left_padding = 0
+    max_width = max(question_image_with_title.shape[1], answer_image_with_title.shape[1])
+    if question_image_with_title.shape[1] < max_width:
+        total_padding = max_width - question_image_with_title.shape[1]
+        left_padding = total_padding // 2
+        right_padding = total_padding - left_padding
+        question_image_with_title = np.pad(question_image_with_title, ((0, 0), (left_padding, right_padding)),
+                                           mode='constant', constant_values=255)
+
+    combined_image = np.vstack((question_image_with_title, answer_image_with_title))
+    add('combined', combined_image,
+        [(frame, y + question_top, x + left_padding) for frame, y, x in question_placements] +
+        [(frame, y + answer_top, x) for frame, y, x in answer_placements])
+
+    share_buffers(templates.values())
+    return templates
+
+
+# Templates only depend on the frame size, so each process builds them once.
+_canvas_templates = {}
+
+
+def get_canvas_templates(img_height, img_width):
+    key = (img_height, img_width)
+    templates = _canvas_templates.get(key)
+    if templates is None:
+        templates = build_canvas_templates(img_height, img_width)
+        _canvas_templates[key] = templates
+    return templates
+
+
+class ImageEncoder(object):
+    """
+    Encodes rendered views to bytes in one of the supported formats:
+
+      png      OpenCV's default PNG settings
+      png:N    PNG with zlib compression level N (0-9; lower is faster)
+      webp     lossless WebP
+      npy      raw NumPy array, for runs where encode time matters most
+
+    All formats are lossless.
+    """
+
+    FORMATS = ('png', 'webp', 'npy')
+
+    def __init__(self, spec='png'):
+        name, _, level = spec.partition(':')
+        if name not in self.FORMATS or (level and (name != 'png' or not level.isdigit() or int(level) > 9)):
+            raise ValueError('Unknown image format "%s"; expected one of png, png:0-9, webp, npy' % spec)
+        self.spec = spec
+        self.extension = '.' + name
+        self.params = []
+        if level:
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, int(level)]
+        elif name == 'webp':
+            # Quality above 100 selects lossless WebP
+            self.params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+
+    def encode(self, image):
+        if self.extension == '.npy':
+            buf = io.BytesIO()
+            np.save(buf, image)
+            return buf.getvalue()
+        ok, data = cv2.imencode(self.extension, image, self.params)
+        if not ok:
+            raise IOError('Could not encode image as %s' % self.spec)
+        return data.tobytes()
+
+
+# cv2.resize handles at most 4 channels with every interpolation method
+RESIZE_CHANNELS = 4
+
+
+def sized_view_name(name, size):
+    return '%s_%dpx' % (name, size)
+
+
+def resize_stack(stack, size):
+    """
+    Resize an (M, H, W) stack of same-shape views so that their longer side
+    is size pixels. The views are passed to cv2.resize as the channels of
+    one image, RESIZE_CHANNELS at a time, so a group of views needs only a
+    fraction of the resize calls.
+    """
+    num_views, height, width = stack.shape
+    scale = size / max(height, width)
+    dsize = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    resized = np.empty((num_views, dsize[1], dsize[0]), dtype=stack.dtype)
+    for start in range(0, num_views, RESIZE_CHANNELS):
+        channels = np.ascontiguousarray(stack[start:start + RESIZE_CHANNELS].transpose(1, 2, 0))
+        out = cv2.resize(channels, dsize, interpolation=interpolation)
+        resized[start:start + RESIZE_CHANNELS] = out.reshape(dsize[1], dsize[0], -1).transpose(2, 0, 1)
+    return resized
+
+
+def encode_views(npz_file, encoder=None, views=None, sizes=(), templates=None):
+    """
+    Render and encode the views of one instance and return a list of
+    (filename, encoded bytes, seconds spent encoding) for each view.
+    If views is given, only the views named in it are rendered.
+
+    The views are rendered into the buffers of the process-wide canvas
+    templates, so concurrent calls from several threads must each pass their
+    own templates: a dict, filled on demand, from frame size to the result
+    of build_canvas_templates.
+
+    For each size in sizes every view is also written downscaled so that
+    its longer side is size pixels, as <view>_<size>px. The resized copies
+    are made from the rendered arrays, with one resize per size for all
+    views of the same shape.
+    """
+    if encoder is None:
+        encoder = ImageEncoder()
+
+    # Load images and generate the grid
+    images = npz_file['image']
+
+    # Assuming the images are all of the same size
+    img_height, img_width = images[0].shape
+
+    encoded = []
+    by_shape = collections.OrderedDict()
+    if templates is None:
+        view_templates = get_canvas_templates(img_height, img_width)
+    else:
+        view_templates = templates.get((img_height, img_width))
+        if view_templates is None:
+            view_templates = build_canvas_templates(img_height, img_width)
+            templates[(img_height, img_width)] = view_templates
+    for name, template in view_templates.items():
+        if views is not None and name not in views:
+            continue
+        image = template.render(images)
+        start = time.perf_counter()
+        data = encoder.encode(image)
+        encoded.append((name + encoder.extension, data, time.perf_counter() - start))
+        if sizes:
+            by_shape.setdefault(image.shape, []).append((name, image.copy()))
+
+    for group in by_shape.values():
+        stack = np.stack([image for _, image in group])
+        for size in sizes:
+            for (name, _), image in zip(group, resize_stack(stack, size)):
+                start = time.perf_counter()
+                data = encoder.encode(image)
+                encoded.append((sized_view_name(name, size) + encoder.extension, data, time.perf_counter() - start))
+    return encoded
+
+
+def _timed_encode(encoder, image):
+    start = time.perf_counter()
+    data = encoder.encode(image)
+    return data, time.perf_counter() - start
+
+
+def encode_views_batch(stack, encoder=None, views=None, executor=None, sizes=()):
+    """
+    Batched encode_views for an (N, 16, H, W) stack of frame stacks. views
+    is None or a list with the view names (or None, for all views) of each
+    instance. Each view is composed for the whole batch at once and its N
+    images are encoded by executor, e.g. a ThreadPoolExecutor (OpenCV
+    releases the GIL while encoding), or serially without one.
+
+    Returns, for each instance, the list encode_views would return. Resized
+    views are made for all instances together.
+    """
+    if encoder is None:
+        encoder = ImageEncoder()
+    encode_map = executor.map if executor is not None else map
+    num_instances, _, img_height, img_width = stack.shape
+    encoded = [[] for _ in range(num_instances)]
+    by_shape = collections.OrderedDict()
+    for name, template in get_canvas_templates(img_height, img_width).items():
+        wanted = [k for k in range(num_instances) if views is None or views[k] is None or name in views[k]]
+        if not wanted:
+            continue
+        images = template.render_batch(stack if len(wanted) == num_instances else stack[wanted])
+        # Encoding finishes before the next view reuses the batch buffer
+        for k, (data, encode_time) in zip(wanted, encode_map(_timed_encode, [encoder] * len(wanted), images)):
+            encoded[k].append((name + encoder.extension, data, encode_time))
+        if sizes:
+            by_shape.setdefault(images.shape[1:], []).append((name, wanted, images.copy()))
+
+    for group in by_shape.values():
+        stack = np.concatenate([images for _, _, images in group])
+        for size in sizes:
+            resized = resize_stack(stack, size)
+            offset = 0
+            for name, wanted, _ in group:
+                part = resized[offset:offset + len(wanted)]
+                offset += len(wanted)
+                for k, (data, encode_time) in zip(wanted, encode_map(_timed_encode, [encoder] * len(wanted), part)):
+                    encoded[k].append((sized_view_name(name, size) + encoder.extension, data, encode_time))
+    return encoded
+
+
+def write_views(save_dir, encoded):
+    """
+    Write the output of encode_views into save_dir and return a list of
+    (filename, bytes written, seconds spent encoding) for each file.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    written = []
+    for filename, data, encode_time in encoded:
+        with open(os.path.join(save_dir, filename), 'wb') as f:
+            f.write(data)
+        written.append((filename, len(data), encode_time))
+    return written
+
+
+def save_image(npz_file, save_dir, idx, encoder=None, views=None, sizes=()):
+    """
+    Write the views of one instance into save_dir and return a list of
+    (filename, bytes written, seconds spent encoding) for each file.
+    If views is given, only the views named in it are rendered; sizes adds
+    downscaled copies as in encode_views.
+    """
+    return write_views(save_dir, encode_views(npz_file, encoder, views, sizes))
+
+
+def render_settings(encoder, sizes=()):
+    """
+    Return a string identifying everything besides the NPZ that determines
+    the rendered images.
+    """
+    return json.dumps({'version': RENDER_VERSION, 'format': encoder.spec, 'sizes': list(sizes)}, sort_keys=True)
+
+
+class RenderManifest(object):
+    """
+    SQLite record of the images rendered into each output directory: the
+    SHA-1 of the source NPZ, the render settings and the size of every file
+    written. A directory is current for a set of views if the hash and
+    settings still match and each of those views was recorded and is still on
+    disk with its recorded size.
+    """
+
+    def __init__(self, path):
+        manifest_dir = os.path.dirname(path)
+        if manifest_dir:
+            os.makedirs(manifest_dir, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS renders '
+                          '(save_dir TEXT PRIMARY KEY, input_hash TEXT, settings TEXT, outputs TEXT)')
+
+    def current_hash(self, save_dir, settings, filenames):
+        """
+        Return the input hash recorded for save_dir if its settings match and
+        all of filenames were recorded and are still on disk with the same
+        size, else None.
+        """
+        row = self.conn.execute('SELECT input_hash, settings, outputs FROM renders WHERE save_dir = ?',
+                                (os.path.abspath(save_dir),)).fetchone()
+        if row is None or row[1] != settings:
+            return None
+        outputs = json.loads(row[2])
+        for filename in filenames:
+            path = os.path.join(save_dir, filename)
+            if filename not in outputs or not os.path.isfile(path) or os.path.getsize(path) != outputs[filename]:
+                return None
+        return row[0]
+
+    def record(self, save_dir, input_hash, settings, written):
+        outputs = {filename: size for filename, size, _ in written}
+        self.conn.execute('INSERT OR REPLACE INTO renders VALUES (?, ?, ?, ?)',
+                          (os.path.abspath(save_dir), input_hash, settings, json.dumps(outputs, sort_keys=True)))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def save_layouts(path, templates):
+    """
+    Save the layout recipe of every view in templates (its background and
+    frame placements) to an .npz file.
+    """
+    arrays = {}
+    for name, template in templates.items():
+        arrays[name + '.background'] = template.background
+        arrays[name + '.placements'] = np.array(template.placements, dtype=np.int64).reshape(-1, 3)
+    np.savez_compressed(path, **arrays)
+
+
+def load_layouts(path, img_height, img_width):
+    """
+    Load the templates saved by save_layouts, keyed by view name.
+    """
+    templates = collections.OrderedDict()
+    with np.load(path) as layouts:
+        names = [key[:-len('.background')] for key in layouts.files if key.endswith('.background')]
+        for name in names:
+            placements = [tuple(int(v) for v in p) for p in layouts[name + '.placements']]
+            templates[name] = CanvasTemplate(layouts[name + '.background'], placements, img_height, img_width)
+    share_buffers(templates.values())
+    return templates
+
+
+class FrameStoreWriter(object):
+    """
+    Writes the RAVEN frames of each instance once instead of the rendered
+    views. Each instance's uint8 (16, H, W) frames are zlib-compressed and
+    appended to <output_dir>/<config>/frames.bin in instance order, with its
+    (offset, size) appended to frames.idx as two little-endian uint64. The
+    frame shape is written to frames.json when a config is opened, so a run
+    that stops early leaves a store that FrameStore can read up to the last
+    complete instance. The layout recipes of the views are saved once per
+    frame size to <output_dir>/layouts-<H>x<W>.npz. FrameStore composes
+    views on read.
+    """
+
+    def __init__(self, output_dir, level=6):
+        self.output_dir = output_dir
+        self.level = level
+        self.files = collections.OrderedDict()
+        self.shapes = {}
+        self.counts = {}
+        self.offsets = {}
+        self.num_bytes = 0
+        self.raw_bytes = 0
+
+    def _open(self, config, shape):
+        config_dir = os.path.join(self.output_dir, config)
+        os.makedirs(config_dir, exist_ok=True)
+        with open(os.path.join(config_dir, 'frames.json'), 'w') as meta:
+            json.dump({'shape': list(shape), 'dtype': 'uint8', 'compression': 'zlib'}, meta)
+        self.files[config] = (open(os.path.join(config_dir, 'frames.bin'), 'wb'),
+                              open(os.path.join(config_dir, 'frames.idx'), 'wb'))
+        self.shapes[config] = shape
+        self.counts[config] = 0
+        self.offsets[config] = 0
+        layout_path = os.path.join(self.output_dir, 'layouts-%dx%d.npz' % shape[1:])
+        if not os.path.exists(layout_path):
+            save_layouts(layout_path, get_canvas_templates(*shape[1:]))
+
+    def append(self, config, idx, images):
+        images = np.ascontiguousarray(images, dtype=np.uint8)
+        if config not in self.files:
+            self._open(config, images.shape)
+        if images.shape != self.shapes[config]:
+            raise ValueError('Frames of %s/%d have shape %s, expected %s'
+                             % (config, idx, images.shape, self.shapes[config]))
+        if idx != self.counts[config]:
+            raise ValueError('Instances of %s must be appended in order; got %d, expected %d'
+                             % (config, idx, self.counts[config]))
+        data = zlib.compress(images.tobytes(), self.level)
+        data_file, index_file = self.files[config]
+        data_file.write(data)
+        index_file.write(np.array([self.offsets[config], len(data)], dtype='<u8').tobytes())
+        self.offsets[config] += len(data)
+        self.counts[config] += 1
+        self.num_bytes += len(data)
+        self.raw_bytes += images.nbytes
+
+    def commit(self):
+        # Frames before their index entries, so every flushed entry is readable
+        for data_file, _ in self.files.values():
+            data_file.flush()
+        for _, index_file in self.files.values():
+            index_file.flush()
+
+    def close(self):
+        self.commit()
+        for data_file, index_file in self.files.values():
+            data_file.close()
+            index_file.close()
+        self.files.clear()
+
+
+class FrameStore(object):
+    """
+    Reads a dataset written with FrameStoreWriter. frames() returns an
+    instance's (16, H, W) frames, and view() and encode() materialize a view
+    from its layout recipe, e.g.
+    store.encode('center_single', 12, 'panel_combination_1_2.png').
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.configs = {}
+        self.layouts = {}
+        self.encoders = {}
+
+    def _config(self, config):
+        entry = self.configs.get(config)
+        if entry is None:
+            config_dir = os.path.join(self.output_dir, config)
+            with open(os.path.join(config_dir, 'frames.json')) as f:
+                meta = json.load(f)
+            data_path = os.path.join(config_dir, 'frames.bin')
+            index = np.fromfile(os.path.join(config_dir, 'frames.idx'), dtype='<u8')
+            index = index[:len(index) // 2 * 2].reshape(-1, 2)
+            # Drop entries whose frames never reached the disk
+            complete = index.sum(axis=1) <= os.path.getsize(data_path)
+            if not complete.all():
+                index = index[:np.argmin(complete)]
+            entry = (tuple(meta['shape']), np.dtype(meta['dtype']), index, open(data_path, 'rb'))
+            self.configs[config] = entry
+        return entry
+
+    def num_instances(self, config):
+        return len(self._config(config)[2])
+
+    def frames(self, config, idx):
+        shape, dtype, index, data_file = self._config(config)
+        if not 0 <= idx < len(index):
+            raise IndexError('%s has %d instances in %s' % (config, len(index), self.output_dir))
+        offset, size = index[idx]
+        data_file.seek(int(offset))
+        return np.frombuffer(zlib.decompress(data_file.read(int(size))), dtype=dtype).reshape(shape)
+
+    def _templates(self, img_height, img_width):
+        key = (img_height, img_width)
+        templates = self.layouts.get(key)
+        if templates is None:
+            templates = load_layouts(os.path.join(self.output_dir, 'layouts-%dx%d.npz' % key), img_height, img_width)
+            self.layouts[key] = templates
+        return templates
+
+    def view(self, config, idx, name):
+        frames = self.frames(config, idx)
+        return self._templates(*frames.shape[1:])[name].render(frames).copy()
+
+    def encode(self, config, idx, filename):
+        name, extension = os.path.splitext(filename)
+        encoder = self.encoders.get(extension)
+        if encoder is None:
+            encoder = ImageEncoder(extension[1:])
+            self.encoders[extension] = encoder
+        return encoder.encode(self.view(config, idx, name))
+
+    def close(self):
+        for _, _, _, data_file in self.configs.values():
+            data_file.close()
+        self.configs.clear()
+
+
+# Render workers receive the RAVEN source once through the pool initializer.
+_worker_source = None
+
+
+def _init_worker(source):
+    global _worker_source
+    _worker_source = source
+
+
+# Encode thread pools, created on first use and reused for every batch a
+# process renders. Keyed by process id too, since a forked worker inherits
+# the dict but not the threads.
+_encode_executors = {}
+
+
+def get_encode_executor(num_threads):
+    key = (os.getpid(), num_threads)
+    executor = _encode_executors.get(key)
+    if executor is None:
+        executor = concurrent.futures.ThreadPoolExecutor(num_threads)
+        _encode_executors[key] = executor
+    return executor
+
+
+def render_scene(source, config, npz_name, save_dir, idx, encoder=None, views=None, sizes=(), current_hash=None,
+                 hash_input=False):
+    """
+    Render one scene's images (or only the given views) into save_dir.
+
+    Returns (seconds, input_hash, written), where written is the list
+    returned by save_image. If save_dir is None nothing is written and
+    written is the list returned by encode_views instead. With hash_input
+    the NPZ's SHA-1 is computed, and if it equals current_hash nothing is
+    rendered and written is None. Without hash_input, input_hash is None.
+    """
+    start = time.perf_counter()
+    if not hash_input:
+        with source.open_npz(config, npz_name) as npz_file:
+            if save_dir is None:
+                written = encode_views(npz_file, encoder, views, sizes)
+            else:
+                written = save_image(npz_file, save_dir, idx, encoder, views, sizes)
+        return time.perf_counter() - start, None, written
+
+    data = source.read(config, npz_name)
+    input_hash = hashlib.sha1(data).hexdigest()
+    if input_hash == current_hash:
+        return time.perf_counter() - start, input_hash, None
+    with raven_io.NpzArchive(io.BytesIO(data)) as npz_file:
+        written = save_image(npz_file, save_dir, idx, encoder, views, sizes)
+    return time.perf_counter() - start, input_hash, written
+
+
+def render_scenes(source, jobs, encode_threads=1):
+    """
+    Batched render_scene: take a list of render_scene argument tuples
+    (without the source) and return the list of their results. Scenes that
+    need rendering are grouped by frame size and composed and encoded with
+    encode_views_batch; each scene is charged an equal share of the time.
+    """
+    start = time.perf_counter()
+    results = [None] * len(jobs)
+    groups = collections.OrderedDict()
+    for k, (config, npz_name, save_dir, idx, encoder, views, sizes, current_hash, hash_input) in enumerate(jobs):
+        input_hash = None
+        if hash_input:
+            data = source.read(config, npz_name)
+            input_hash = hashlib.sha1(data).hexdigest()
+            if input_hash == current_hash:
+                results[k] = (0.0, input_hash, None)
+                continue
+            npz_file = raven_io.NpzArchive(io.BytesIO(data))
+        else:
+            npz_file = source.open_npz(config, npz_name)
+        with npz_file:
+            images = npz_file['image']
+        groups.setdefault(images.shape, []).append((k, input_hash, images))
+
+    executor = get_encode_executor(encode_threads) if encode_threads > 1 else None
+    for group in groups.values():
+        stack = np.stack([images for _, _, images in group])
+        encoder, sizes = jobs[group[0][0]][4], jobs[group[0][0]][6]
+        encoded = encode_views_batch(stack, encoder, [jobs[k][5] for k, _, _ in group], executor, sizes)
+        for (k, input_hash, _), views in zip(group, encoded):
+            save_dir = jobs[k][2]
+            written = views if save_dir is None else write_views(save_dir, views)
+            results[k] = (0.0, input_hash, written)
+
+    seconds = (time.perf_counter() - start) / max(len(jobs), 1)
+    return [(seconds,) + result[1:] for result in results]
+
+
+def _render_worker(job):
+    return render_scene(_worker_source, *job)
+
+
+def _render_batch_worker(jobs, encode_threads):
+    return render_scenes(_worker_source, jobs, encode_threads)
+
+
+class RenderPool(object):
+    """
+    Image rendering stage that runs next to question generation.
+
+    If a RenderManifest is given, output directories that are current are
+    not rendered again and newly rendered ones are recorded in it.
+
+    If a writer such as raven_io.ShardWriter is given, nothing is written to
+    disk by the workers: the save_dir passed to submit() is used as the
+    sample key, and the encoded views are handed to writer.write(key, files)
+    in submission order, after any extra files given for the sample.
+
+    submit() queues a scene for rendering and returns immediately. At most
+    max_pending scenes are queued or in flight; once that many are waiting,
+    submit() blocks until the oldest one is done, so memory stays bounded
+    when rendering is slower than question generation. Errors raised by a
+    worker are re-raised in the caller. With num_workers == 0 scenes are
+    rendered synchronously in the calling process.
+
+    With batch_size > 1, submitted scenes are collected into batches that
+    are rendered with render_scenes, each encoded by encode_threads threads;
+    max_pending then counts batches. commit() renders a partial batch.
+    """
+
+    def __init__(self, source, num_workers=0, max_pending=64, manifest=None, encoder=None, writer=None,
+                 batch_size=1, encode_threads=1, sizes=()):
+        if manifest is not None and writer is not None:
+            raise ValueError('A render manifest only applies to images written to output directories')
+        self.source = source
+        self.manifest = manifest
+        self.writer = writer
+        self.encoder = encoder if encoder is not None else ImageEncoder()
+        self.sizes = tuple(sizes)
+        self.settings = render_settings(self.encoder, self.sizes)
+        self.max_pending = max(1, max_pending)
+        self.batch_size = batch_size
+        self.encode_threads = encode_threads
+        self.batch = []
+        self.pending = collections.deque()
+        self.draining = False
+        self.pool = None
+        if num_workers > 0:
+            self.pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(source,))
+        self.num_rendered = 0
+        self.num_skipped = 0
+        self.num_images = 0
+        self.encoded_bytes = 0
+        self.encode_time = 0.0
+        self.render_time = 0.0
+        self.wait_time = 0.0
+        self.drain_time = 0.0
+        self.start_time = time.perf_counter()
+
+    def _finish(self, save_dir, extra_files, result):
+        seconds, input_hash, written = result
+        self.render_time += seconds
+        if written is None:
+            self.num_skipped += 1
+            return
+        self.num_rendered += 1
+        if self.writer is not None:
+            self.writer.write(save_dir, list(extra_files) + [(filename, data) for filename, data, _ in written])
+            written = [(filename, len(data), encode_time) for filename, data, encode_time in written]
+        for _, size, encode_time in written:
+            self.num_images += 1
+            self.encoded_bytes += size
+            self.encode_time += encode_time
+        if self.manifest is not None:
+            self.manifest.record(save_dir, input_hash, self.settings, written)
+
+    def _finish_oldest(self):
+        start = time.perf_counter()
+        targets, results, batched = self.pending.popleft()
+        results = results.get()
+        # Only waits forced by a full queue stall the producer; the final
+        # drain in close() is counted separately
+        if self.draining:
+            self.drain_time += time.perf_counter() - start
+        else:
+            self.wait_time += time.perf_counter() - start
+        if not batched:
+            results = [results]
+        for (save_dir, extra_files), result in zip(targets, results):
+            self._finish(save_dir, extra_files, result)
+
+    def _flush(self):
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        jobs = [job for _, _, job in batch]
+        targets = [(save_dir, extra_files) for save_dir, extra_files, _ in batch]
+        if self.pool is None:
+            for (save_dir, extra_files), result in zip(targets, render_scenes(self.source, jobs, self.encode_threads)):
+                self._finish(save_dir, extra_files, result)
+            return
+        while len(self.pending) >= self.max_pending:
+            self._finish_oldest()
+        self.pending.append((targets, self.pool.apply_async(_render_batch_worker, (jobs, self.encode_threads)), True))
+
+    def submit(self, config, npz_name, save_dir, idx, views=None, extra_files=()):
+        """
+        Queue a scene for rendering. If views is given, only the views named
+        in it are rendered. extra_files, a list of (name, bytes) pairs, is
+        only used with a writer.
+        """
+        job = (config, npz_name, None if self.writer is not None else save_dir, idx, self.encoder, views, self.sizes)
+        if self.manifest is not None:
+            # Names encode_views does not know are never written, so they
+            # must not keep the directory from being current
+            names = [name for name in VIEW_NAMES if views is None or name in views]
+            names += [sized_view_name(name, size) for size in self.sizes for name in names]
+            filenames = [name + self.encoder.extension for name in names]
+            job += (self.manifest.current_hash(save_dir, self.settings, filenames), True)
+        else:
+            job += (None, False)
+        if self.batch_size > 1:
+            self.batch.append((save_dir, extra_files, job))
+            if len(self.batch) >= self.batch_size:
+                self._flush()
+            return
+        if self.pool is None:
+            self._finish(save_dir, extra_files, render_scene(self.source, *job))
+            return
+        while len(self.pending) >= self.max_pending:
+            self._finish_oldest()
+        self.pending.append(([(save_dir, extra_files)], self.pool.apply_async(_render_worker, (job,)), False))
+
+    def commit(self):
+        """
+        Render any partial batch and commit the manifest or writer. Scenes
+        still in flight are recorded when they finish.
+        """
+        self._flush()
+        if self.manifest is not None:
+            self.manifest.commit()
+        if self.writer is not None:
+            self.writer.commit()
+
+    def close(self):
+        """
+        Wait for all queued scenes and shut the workers down.
+        """
+        self.draining = True
+        try:
+            self._flush()
+            while self.pending:
+                self._finish_oldest()
+            self.commit()
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        self.elapsed = time.perf_counter() - self.start_time
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def report(self):
+        """
+        Return a summary of the render stage's throughput and of the bytes
+        and time spent encoding.
+        """
+        elapsed = getattr(self, 'elapsed', time.perf_counter() - self.start_time)
+        num_scenes = self.num_rendered + self.num_skipped
+        return ('render: %d scenes (%d up to date), %.1fs of rendering in %.1fs wall (%.1f scenes/s), '
+                'producer blocked %.1fs, final drain %.1fs\n'
+                'encode %s: %d images, %.1f MB (%.1f KB/image), %.2fs (%.2f ms/image)'
+                % (num_scenes, self.num_skipped, self.render_time, elapsed,
+                   num_scenes / max(elapsed, 1e-9), self.wait_time, self.drain_time,
+                   self.encoder.spec, self.num_images, self.encoded_bytes / 1e6,
+                   self.encoded_bytes / 1e3 / max(self.num_images, 1), self.encode_time,
+                   self.encode_time * 1e3 / max(self.num_images, 1)))
@@ -0,0 +1,272 @@
+"""
+Local HTTP service that renders the image views of a generated dataset on
+demand instead of reading them from disk.
+
+Requests use the same relative paths as the image_filename values in the
+question JSON, e.g.
+
+    python serve_images.py --dataset_dir ./dataset/ --port 8000
+    curl http://127.0.0.1:8000/center_single/12/panel_3.png
+
+Each <config>/<i> is mapped to its RAVEN NPZ through the scene index written
+by generate_direct_answer_questions.py, and the view is rendered with the
+same layout code as save_image. The extension selects the encoder (.png,
+.webp or .npy). Recently served views are kept in a bounded in-memory LRU.
+<config>/<i>/question.json is served from the path recorded in the index.
+"""
+
+import os
+import argparse
+import threading
+import collections
+import http.server
+import urllib.parse
+import raven_io
+import raven_render
+
+CONTENT_TYPES = {
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+    '.npy': 'application/octet-stream',
+    '.json': 'application/json',
+}
+
+
+class ViewCache(object):
+    """
+    Thread-safe LRU of encoded views, bounded by their total size in bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.num_bytes -= len(old)
+            self.entries[key] = data
+            self.num_bytes += len(data)
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.num_bytes -= len(evicted)
+
+
+class Renderer(object):
+    """
+    The RAVEN sources and canvas templates used by one request at a time.
+    ZipSource reads through a single file handle and templates render into
+    their own buffers, so concurrent requests cannot share them.
+    """
+
+    def __init__(self):
+        self.sources = {}
+        self.templates = {}
+
+    def source(self, path, shared):
+        """
+        Return this renderer's clone of the source for path, which is shared
+        by all renderers; clones share the member index but not the file
+        handle.
+        """
+        source = self.sources.get(path)
+        if source is None:
+            source = shared.clone()
+            self.sources[path] = source
+        return source
+
+    def close(self):
+        for source in self.sources.values():
+            source.close()
+        self.sources.clear()
+
+
+class ImageService(object):
+    """
+    Looks up instances in the scene index and renders their views.
+
+    If raven_src is given, NPZ files are read from that RAVEN folder or
+    RAVEN.zip; otherwise from the locations recorded in the index.
+    """
+
+    def __init__(self, index_path, cache_bytes, raven_src=None):
+        self.cache = ViewCache(cache_bytes)
+        self.raven_src = raven_src
+        self.encoders = {}
+        # The server starts a thread per request, so the index is one
+        # connection shared by all of them behind index_lock
+        self.index = raven_io.SceneIndex(index_path, check_same_thread=False)
+        self.index_lock = threading.Lock()
+        # Sources are opened once, reading the zip directory a single time,
+        # and renderers are reused across requests; at most one is created
+        # per concurrent request
+        self.sources = {}
+        self.renderers = []
+        self.idle_renderers = []
+        self.lock = threading.Lock()
+
+    def _row(self, config, idx):
+        with self.index_lock:
+            return self.index.get(config, idx)
+
+    def _encoder(self, extension):
+        encoder = self.encoders.get(extension)
+        if encoder is None:
+            encoder = raven_render.ImageEncoder(extension[1:])
+            self.encoders[extension] = encoder
+        return encoder
+
+    def _source(self, path):
+        with self.lock:
+            source = self.sources.get(path)
+            if source is None:
+                source = raven_io.open_source(path)
+                self.sources[path] = source
+            return source
+
+    def _acquire_renderer(self):
+        with self.lock:
+            if self.idle_renderers:
+                return self.idle_renderers.pop()
+            renderer = Renderer()
+            self.renderers.append(renderer)
+            return renderer
+
+    def _release_renderer(self, renderer):
+        with self.lock:
+            self.idle_renderers.append(renderer)
+
+    def _open_npz(self, renderer, row):
+        config = row['config']
+        npz_name = os.path.splitext(row['filename'])[0] + '.npz'
+        if self.raven_src is not None:
+            return renderer.source(self.raven_src, self._source(self.raven_src)).open_npz(config, npz_name)
+        if row['npz_offset'] == 0 and row['npz_path'].endswith('.npz'):
+            return raven_io.NpzArchive(row['npz_path'])
+        # The NPZ is a member of RAVEN.zip
+        return renderer.source(row['npz_path'], self._source(row['npz_path'])).open_npz(config, npz_name)
+
+    def get(self, config, idx, filename):
+        """
+        Return (content type, bytes) for one file of an instance, or None if
+        the instance or view does not exist.
+        """
+        name, extension = os.path.splitext(filename)
+        if extension not in CONTENT_TYPES:
+            return None
+        if filename == 'question.json':
+            row = self._row(config, idx)
+            if row is None or not os.path.isfile(row['question_path']):
+                return None
+            with open(row['question_path'], 'rb') as f:
+                return CONTENT_TYPES[extension], f.read()
+        if name not in raven_render.VIEW_NAMES or extension == '.json':
+            return None
+
+        key = (config, idx, filename)
+        data = self.cache.get(key)
+        if data is not None:
+            return CONTENT_TYPES[extension], data
+        row = self._row(config, idx)
+        if row is None:
+            return None
+        renderer = self._acquire_renderer()
+        try:
+            with self._open_npz(renderer, row) as npz_file:
+                (_, data, _), = raven_render.encode_views(npz_file, self._encoder(extension), {name},
+                                                          templates=renderer.templates)
+        except FileNotFoundError:
+            # The RAVEN files have moved since the index was written
+            return None
+        finally:
+            self._release_renderer(renderer)
+        self.cache.put(key, data)
+        return CONTENT_TYPES[extension], data
+
+    def close(self):
+        with self.lock:
+            for renderer in self.renderers:
+                renderer.close()
+            for source in self.sources.values():
+                source.close()
+            self.renderers = []
+            self.idle_renderers = []
+            self.sources = {}
+        with self.index_lock:
+            self.index.close()
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        parts = urllib.parse.urlparse(self.path).path.strip('/').split('/')
+        result = None
+        if len(parts) == 3 and parts[1].isdigit():
+            result = self.service.get(parts[0], int(parts[1]), parts[2])
+        if result is None:
+            self.send_error(404)
+            return
+        content_type, data = result
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+parser = argparse.ArgumentParser(description="Serve dataset images rendered on demand from the RAVEN NPZ files")
+parser.add_argument('--dataset_dir', default='./dataset/',
+                    help="Directory written by generate_direct_answer_questions.py")
+parser.add_argument('--scene_index', default='',
+                    help="Scene index to map <config>/<i> to NPZ files. " +
+                         "Defaults to scene_index.sqlite inside dataset_dir.")
+parser.add_argument('--RAVEN_src_file', default='',
+                    help="Read NPZ files from this RAVEN folder or RAVEN.zip instead of the locations " +
+                         "recorded in the scene index")
+parser.add_argument('--host', default='127.0.0.1',
+                    help="Address to listen on")
+parser.add_argument('--port', default=8000, type=int,
+                    help="Port to listen on")
+parser.add_argument('--cache_mb', default=256, type=int,
+                    help="Size of the in-memory cache of rendered views in megabytes")
+
+
+def main(args):
+    index_path = args.scene_index or os.path.join(args.dataset_dir, 'scene_index.sqlite')
+    if not os.path.isfile(index_path):
+        raise FileNotFoundError('No scene index at %s; run generate_direct_answer_questions.py or raven_io.py first'
+                                % index_path)
+    service = ImageService(index_path, args.cache_mb << 20, args.RAVEN_src_file or None)
+    RequestHandler.service = service
+    server = http.server.ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    print('serving %s on http://%s:%d/' % (args.dataset_dir, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)